@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+'''
+Compares :func:`photon.util.structures.dict_merge` with
+:func:`photon.util.structures.dict_merge_shared` (copying and in place)
+on settings- and meta-sized structures.
+'''
+
+from argparse import ArgumentParser
+from copy import deepcopy
+from gc import disable, enable
+from os import path
+from sys import path as syspath
+from time import perf_counter
+
+syspath.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from photon.util.structures import dict_merge, dict_merge_shared  # noqa
+
+
+def settings(sections, override=False):
+    return dict(('section_%04d' % (n), dict(
+        name='section %d' % (n),
+        enabled=not override,
+        retries=n % 5,
+        hosts=['alpha', 'beta', 'gamma'],
+        nested=dict(
+            one=dict(a=1, b=2.5, c='text'),
+            two=dict(x=[1, 2, 3], y=dict(deep=dict(deeper=n)))
+        )
+    ) if not override else dict(enabled=False)) for n in range(
+        0, sections, 10 if override else 1
+    ))
+
+
+def meta(entries, offset=0):
+    return dict(
+        header=dict(ident='photon-1A2B', verbose=False, stage='meta.json'),
+        log=dict(('photon-1A2B-%08d' % (n + offset), dict(
+            message='entry %d' % (n), seq=n + offset, time=1420070400.0 + n,
+            more=dict(
+                command='git status', returncode=0,
+                out='On branch master\nnothing to commit', cwd='/srv'
+            ),
+            verbose=False
+        )) for n in range(entries))
+    )
+
+
+def argparse():
+    parser = ArgumentParser(
+        prog='photon merge benchmark',
+        description='Compare dict_merge and dict_merge_shared',
+        add_help=True
+    )
+    parser.add_argument(
+        '--number', '-n',
+        action='store',
+        type=int,
+        default=5,
+        help='Merges per measurement'
+    )
+    parser.add_argument(
+        '--repeat', '-r',
+        action='store',
+        type=int,
+        default=3,
+        help='Number of measurements (the best one is shown)'
+    )
+    return parser.parse_args()
+
+
+def measure(func, o, number):
+    '''
+    Each merge gets it's own fresh copy of `o`, built outside
+    of the timed section. So all variants start from the same
+    (not yet cached) state, and only the merge itself is timed
+    '''
+
+    total = 0
+    for _ in range(number):
+        c = deepcopy(o)
+        disable()
+        try:
+            start = perf_counter()
+            func(c)
+            total += perf_counter() - start
+        finally:
+            enable()
+    return total
+
+
+def main(number, rep):
+    cases = [
+        ('settings small', settings(20), settings(20, override=True)),
+        ('settings large', settings(2000), settings(2000, override=True)),
+        ('meta 1k+100', meta(1000), meta(100, offset=1000)),
+        ('meta 20k+1k', meta(20000), meta(1000, offset=20000)),
+    ]
+    for name, o, v in cases:
+        for func, label in [
+            (lambda c: dict_merge(c, v), 'dict_merge'),
+            (lambda c: dict_merge_shared(c, v), 'shared'),
+            (lambda c: dict_merge_shared(c, v, inplace=True),
+             'shared inplace'),
+        ]:
+            times = [measure(func, o, number) for _ in range(rep)]
+            print('%-16s %-16s %10.3f ms/merge' % (
+                name, label, min(times) / number * 1000
+            ))
+
+
+if __name__ == '__main__':
+    args = argparse()
+
+    main(args.number, args.repeat)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+'''
+Measures the latency of :func:`photon.util.files.write_file`
+for each durability policy, with a small config-sized and a larger
+meta-sized payload.
+'''
+
+from argparse import ArgumentParser
+from json import dumps
+from os import path
+from sys import path as syspath
+from tempfile import TemporaryDirectory
+from timeit import repeat
+
+syspath.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from photon.util.files import DURABILITY, write_file  # noqa
+
+
+def payload(entries):
+    return dumps(dict(log=dict(
+        ('2015.01.01-00.00.00-%06d' % (n), dict(
+            message='entry %d' % (n), more=dict(returncode=0), verbose=False
+        )) for n in range(entries)
+    )), indent=4, sort_keys=True)
+
+
+def argparse():
+    parser = ArgumentParser(
+        prog='photon write benchmark',
+        description='Compare the durability policies of write_file',
+        add_help=True
+    )
+    parser.add_argument(
+        '--number', '-n',
+        action='store',
+        type=int,
+        default=50,
+        help='Writes per measurement'
+    )
+    parser.add_argument(
+        '--repeat', '-r',
+        action='store',
+        type=int,
+        default=5,
+        help='Number of measurements (the best one is shown)'
+    )
+    return parser.parse_args()
+
+
+def main(number, rep):
+    with TemporaryDirectory() as tmp:
+        target = path.join(tmp, 'bench.json')
+        for name, entries in [('config', 10), ('meta', 5000)]:
+            content = payload(entries)
+            for durability in DURABILITY:
+                best = min(repeat(
+                    lambda: write_file(
+                        target, content, durability=durability
+                    ),
+                    number=number, repeat=rep
+                ))
+                print('%-6s %8d bytes  %-16s %10.3f ms/write' % (
+                    name, len(content), durability, best / number * 1000
+                ))
+
+
+if __name__ == '__main__':
+    args = argparse()
+
+    main(args.number, args.repeat)
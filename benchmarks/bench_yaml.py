@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+'''
+Measures loading and writing back a large defaults file,
+with the pure-Python YAML loader/dumper and the ones of
+:class:`photon.settings.Settings` (libyaml, if available).
+'''
+
+from argparse import ArgumentParser
+from os import path
+from sys import path as syspath
+from tempfile import TemporaryDirectory
+from timeit import repeat
+
+import yaml
+
+syspath.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from photon.settings import SettingsDumper, SettingsLoader  # noqa
+from photon.util.files import read_yaml, write_yaml  # noqa
+from photon.util.structures import yaml_loc_join, yaml_str_join  # noqa
+
+
+def defaults(sections):
+    return '\n'.join(
+        '''section_%04d:
+    name: &name_%04d section %d
+    label: !str_join [*name_%04d, ' - ', label]
+    folder: !loc_join [data_dir, section_%04d]
+    enabled: true
+    retries: %d
+    hosts: [alpha, beta, gamma, delta]
+    nested:
+        one: {a: 1, b: 2.5, c: text}
+        two: [x, y, z]''' % (n, n, n, n, n, n) for n in range(sections)
+    ) + '\n'
+
+
+def argparse():
+    parser = ArgumentParser(
+        prog='photon yaml benchmark',
+        description='Compare pure-Python and libyaml settings loading',
+        add_help=True
+    )
+    parser.add_argument(
+        '--sections', '-s',
+        action='store',
+        type=int,
+        default=500,
+        help='Size of the generated defaults file'
+    )
+    parser.add_argument(
+        '--number', '-n',
+        action='store',
+        type=int,
+        default=5,
+        help='Loads/writes per measurement'
+    )
+    parser.add_argument(
+        '--repeat', '-r',
+        action='store',
+        type=int,
+        default=3,
+        help='Number of measurements (the best one is shown)'
+    )
+    return parser.parse_args()
+
+
+def main(sections, number, rep):
+    class PythonLoader(yaml.SafeLoader):
+        pass
+
+    PythonLoader.add_constructor('!str_join', yaml_str_join)
+    PythonLoader.add_constructor('!loc_join', yaml_loc_join)
+
+    with TemporaryDirectory() as tmp:
+        source = path.join(tmp, 'defaults.yaml')
+        target = path.join(tmp, 'config.yaml')
+        with open(source, 'w') as f:
+            f.write(defaults(sections))
+        content = read_yaml(source, loader=SettingsLoader)
+
+        print('%d bytes, %d sections' % (path.getsize(source), sections))
+        for name, loader, dumper in [
+            ('python', PythonLoader, yaml.SafeDumper),
+            ('settings', SettingsLoader, SettingsDumper),
+        ]:
+            for action, func in [
+                ('load', lambda: read_yaml(source, loader=loader)),
+                ('write', lambda: write_yaml(target, content, dumper=dumper)),
+            ]:
+                best = min(repeat(func, number=number, repeat=rep))
+                print('%-8s %-5s %10.3f ms' % (
+                    name, action, best / number * 1000
+                ))
+
+
+if __name__ == '__main__':
+    args = argparse()
+
+    main(args.sections, args.number, args.repeat)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from os import path
+from sys import exit
+
+from photon.meta import filter_log, iter_log, read_header
+from photon.metaindex import MetaIndex
+from photon.util.formatters import FTYPES, fmt
+
+
+def timestamp(t):
+    try:
+        return float(t)
+    except ValueError:
+        return t
+
+
+def argparse():
+    parser = ArgumentParser(
+        prog='photon meta',
+        description='Reads photon meta files incrementally \
+            to display (some of) their log entries. \
+            Pass a folder to search the index of all meta files within',
+        epilog='-.-',
+        add_help=True
+    )
+    parser.add_argument(
+        '--formatter', '-f',
+        action='store',
+        default='pp',
+        choices=sorted(FTYPES.keys()),
+        help='Use a formatter to print. \
+            Choose between p_rint p_retty_p_rint (default), \
+            j_son, y_aml or nested t_abs'
+    )
+    parser.add_argument(
+        '--since', '-s',
+        action='store',
+        type=timestamp,
+        default=None,
+        help='Only entries from then on \
+            (seconds since the epoch or YYYY.MM.DD-HH.MM.SS)'
+    )
+    parser.add_argument(
+        '--until', '-u',
+        action='store',
+        type=timestamp,
+        default=None,
+        help='Only entries up to then \
+            (seconds since the epoch or YYYY.MM.DD-HH.MM.SS)'
+    )
+    parser.add_argument(
+        '--message', '-m',
+        action='store',
+        default=None,
+        help='Only entries whose message matches this regular expression'
+    )
+    parser.add_argument(
+        '--command', '-c',
+        action='store',
+        default=None,
+        help='Only entries whose command contains this'
+    )
+    state = parser.add_mutually_exclusive_group()
+    state.add_argument(
+        '--failed',
+        action='store_const',
+        dest='failed',
+        const=True,
+        default=None,
+        help='Only failed entries'
+    )
+    state.add_argument(
+        '--succeeded',
+        action='store_const',
+        dest='failed',
+        const=False,
+        help='Only entries which did not fail'
+    )
+    parser.add_argument(
+        '--raw', '-r',
+        action='store_true',
+        default=False,
+        help='Do not rehydrate blobs referenced by the entries \
+            (filtering by failed state or command may miss some)'
+    )
+    parser.add_argument(
+        '--limit', '-l',
+        action='store',
+        type=int,
+        default=None,
+        help='Show not more than this many entries \
+            (only when searching a folder, newest first)'
+    )
+    parser.add_argument(
+        '--header',
+        action='store_true',
+        default=False,
+        help='Show the header instead of log entries'
+    )
+    parser.add_argument(
+        'stage',
+        help='The meta file to read (a stage, it\'s journal or a database) \
+            or a folder to index (e.g. the data_dir)'
+    )
+    return parser.parse_args()
+
+
+def search(location, ftype, limit=None, **filters):
+    index = MetaIndex(location)
+    try:
+        index.scan()
+        for entry in index.query(limit=limit, **filters):
+            fmt(entry, ftype)
+    finally:
+        index.close()
+
+
+def main(stage, ftype, header=False, resolve=False, **filters):
+    if header:
+        return fmt(read_header(stage), ftype)
+
+    for key, elem in filter_log(iter_log(stage, resolve=resolve), **filters):
+        fmt({key: elem}, ftype)
+
+
+if __name__ == '__main__':
+    args = argparse()
+
+    args.stage = path.abspath(path.expanduser(args.stage))
+    if args.stage.endswith('.jsonl'):
+        args.stage = '%s.json' % (path.splitext(args.stage)[0])
+
+    filters = dict(
+        since=args.since, until=args.until, message=args.message,
+        failed=args.failed, command=args.command
+    )
+    if path.isdir(args.stage):
+        search(args.stage, args.formatter, limit=args.limit, **filters)
+    else:
+        try:
+            main(
+                args.stage, args.formatter,
+                header=args.header, resolve=not args.raw, **filters
+            )
+        except ValueError as ex:
+            exit('could not read %s: %s' % (args.stage, ex))
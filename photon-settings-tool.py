@@ -1,49 +1,18 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
-from json import dumps
+from json import dumps, loads
 from os import path, sep
-from pprint import pformat
+from re import sub
+from shlex import quote
+from socket import AF_UNIX, SOCK_STREAM, socket
+from sys import exit, stderr, stdout
 
-from photon import Settings
-from yaml import dump
+# The client (--socket) only needs the imports above,
+# photon itself is imported when the settings are read here.
 
-
-def _p(s):
-    print(s)
-
-
-def _pp(s):
-    return _p(pformat(s))
-
-
-def _j(s):
-    return _p(dumps(s, indent=4, sort_keys=True))
-
-
-def _y(s):
-    return _p(dump(s, indent=4, default_flow_style=False))
-
-
-def _t(s, p=0):
-    if isinstance(s, (str, int, float)):
-        return _p('%s%s' % ('\t'*p, s))
-
-    if isinstance(s, list):
-        return [_t(t, p) for t in s]
-
-    if isinstance(s, dict):
-        for t, u in sorted(s.items()):
-            _t(t, p)
-            _t(u, p+1)
-        return
-
-FTYPES = {'j': _j, 'p': _p, 'pp': _pp, 't': _t, 'y': _y}
-
-
-def fmt(structure, ftype):
-    if ftype in FTYPES.keys():
-        FTYPES[ftype](structure)
+FORMATTERS = ['j', 'p', 'pp', 't', 'y']
+BATCH = ['export', 'nul', 'json']
 
 
 def argparse():
@@ -70,7 +39,7 @@ def argparse():
         '--formatter', '-f',
         action='store',
         default='pp',
-        choices=sorted(FTYPES.keys()),
+        choices=FORMATTERS,
         help='Use a formatter to print. \
             Choose between p_rint p_retty_p_rint (default), \
             j_son, y_aml or nested t_abs'
@@ -81,34 +50,268 @@ def argparse():
         default=False,
         help='Show info and warn messages'
     )
+    parser.add_argument(
+        '--paths', '-p',
+        action='store_true',
+        default=False,
+        help='Show the dotted paths of all values below the selected one'
+    )
+    parser.add_argument(
+        '--find',
+        action='store',
+        default=None,
+        help='Show the dotted paths of all values equal to this \
+            (parsed as YAML, so numbers and booleans work as well)'
+    )
+    parser.add_argument(
+        '--set', '-s',
+        action='append',
+        default=None,
+        dest='overrides',
+        metavar='PATH=VALUE',
+        help='Override a value by it\'s dotted path \
+            (parsed as YAML, can be repeated)'
+    )
+    parser.add_argument(
+        '--provenance',
+        action='store_true',
+        default=False,
+        help='Show where the selected value comes from instead'
+    )
+    parser.add_argument(
+        '--batch', '-b',
+        action='store',
+        default=None,
+        choices=BATCH,
+        help='Select each of the settings by it\'s own dotted path \
+            and print them all at once: \
+            as export-lines for the shell to eval (named like the path), \
+            as NUL-terminated pairs of path and value, \
+            or as one json object. Missing paths are left out'
+    )
+    parser.add_argument(
+        '--prefix',
+        action='store',
+        default=None,
+        help='Also select all values below this dotted path (with --batch)'
+    )
+    parser.add_argument(
+        '--serve',
+        action='store',
+        default=None,
+        metavar='SOCKET',
+        help='Keep the settings loaded and answer queries \
+            on this UNIX socket (reloading them when the files change)'
+    )
+    parser.add_argument(
+        '--socket',
+        action='store',
+        default=None,
+        help='Ask the server listening on this UNIX socket (see --serve), \
+            falls back to reading the settings here if there is none. \
+            --defaults and --config of the server are used'
+    )
     parser.add_argument(
         'settings',
         nargs='*',
-        help='Space separated list into settings'
+        help='Space separated list into settings (or a dotted path)'
     )
     return parser.parse_args()
 
 
-def main(defaults, settings, config=None, verbose=True):
-    res = Settings(defaults, config=config, verbose=verbose).get
-    for s in settings:
-        if s in res:
-            res = res[s]
-        else:
-            return False
+def query(s, settings, paths=False, find=None, provenance=False):
+    from yaml import safe_load
+
+    index = s.index
+    if find is not None:
+        return [index.dotted(p) for p in index.find(safe_load(find))]
+
+    path = index.path(settings[0] if len(settings) == 1 else settings)
+    if path is None:
+        return False
+    if provenance:
+        return s.provenance(path)
+    if paths:
+        return [index.dotted(p) for p in index.paths(path)]
+    return index[path]
+
+
+def collect(s, settings, prefix=None):
+    index = s.index
+    res = dict()
+    for setting in settings:
+        p = index.path(setting)
+        if p is not None:
+            res[index.dotted(p)] = index[p]
+    if prefix is not None:
+        for p in index.paths(prefix):
+            res[index.dotted(p)] = index[p]
     return res
 
 
+def render(values, batch):
+    if batch == 'json':
+        return dumps(values, indent=4, default=str) + '\n'
+
+    def text(value):
+        return value if isinstance(value, str) else dumps(value, default=str)
+
+    if batch == 'nul':
+        return ''.join(
+            '%s\0%s\0' % (key, text(value)) for key, value in values.items()
+        )
+    return ''.join('export %s=%s\n' % (
+        sub(r'^(?=\d)', '_', sub(r'\W', '_', key)).upper(), quote(text(value))
+    ) for key, value in values.items())
+
+
+def main(defaults, settings, config=None, verbose=True,
+         paths=False, find=None, overrides=None, provenance=False,
+         batch=None, prefix=None):
+    from photon import Settings
+
+    s = Settings(defaults, config=config, verbose=verbose, overrides=overrides)
+    if batch:
+        return render(collect(s, settings, prefix=prefix), batch)
+    return query(
+        s, settings, paths=paths, find=find, provenance=provenance
+    )
+
+
+def serve(address, defaults, config=None, verbose=True, overrides=None):
+    from contextlib import redirect_stdout, suppress
+    from io import StringIO
+    from os import remove, stat
+    from signal import SIGTERM, signal
+    from socketserver import StreamRequestHandler, \
+        ThreadingUnixStreamServer
+    from stat import S_ISSOCK
+    from threading import Lock
+
+    from yaml import YAMLError
+
+    from photon import Settings
+    from photon.util.formatters import fmt
+
+    s = Settings(defaults, config=config, verbose=verbose, overrides=overrides)
+    lock = Lock()
+
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    r = loads(line.decode('utf-8'))
+                    if r.get('formatter', 'pp') not in FORMATTERS or (
+                        r.get('batch') and r['batch'] not in BATCH
+                    ):
+                        raise ValueError('unknown formatter')
+                    output = StringIO()
+                    lock.acquire()
+                    try:
+                        s.reload()
+                        if r.get('batch'):
+                            output.write(render(collect(
+                                s, r.get('settings', list()),
+                                prefix=r.get('prefix')
+                            ), r['batch']))
+                        else:
+                            with redirect_stdout(output):
+                                fmt(query(
+                                    s, r.get('settings', list()),
+                                    paths=r.get('paths', False),
+                                    find=r.get('find'),
+                                    provenance=r.get('provenance', False)
+                                ), r.get('formatter', 'pp'))
+                    finally:
+                        lock.release()
+                    res = dict(output=output.getvalue())
+                except (
+                    AttributeError, TypeError, ValueError, YAMLError
+                ) as ex:
+                    res = dict(error=str(ex))
+                self.wfile.write((dumps(res) + '\n').encode('utf-8'))
+                self.wfile.flush()
+
+    if path.exists(address) and S_ISSOCK(stat(address).st_mode):
+        probe = socket(AF_UNIX, SOCK_STREAM)
+        try:
+            probe.connect(address)
+        except OSError:
+            remove(address)
+        else:
+            exit('already served: %s' % (address))
+        finally:
+            probe.close()
+    server = ThreadingUnixStreamServer(address, Handler)
+    server.daemon_threads = True
+    signal(SIGTERM, lambda *_: exit())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        with suppress(FileNotFoundError):
+            remove(address)
+
+
+def ask(address, request):
+    client = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        client.connect(address)
+        client.sendall((dumps(request) + '\n').encode('utf-8'))
+        res = b''
+        while not res.endswith(b'\n'):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            res += chunk
+    except OSError:
+        return
+    finally:
+        client.close()
+    if res:
+        return loads(res.decode('utf-8'))
+
+
 if __name__ == '__main__':
     args = argparse()
 
     if args.config and sep in args.config:
         args.config = path.abspath(path.expanduser(args.config))
 
-    fmt(
-        main(
-            args.defaults, args.settings,
-            config=args.config, verbose=args.verbose
-        ),
-        args.formatter
+    if args.serve:
+        serve(
+            path.abspath(args.serve), args.defaults,
+            config=args.config, verbose=args.verbose,
+            overrides=args.overrides
+        )
+        exit()
+
+    if args.socket and not args.overrides:
+        res = ask(args.socket, dict(
+            settings=args.settings, formatter=args.formatter,
+            paths=args.paths, find=args.find, provenance=args.provenance,
+            batch=args.batch, prefix=args.prefix
+        ))
+        if res is not None:
+            if 'error' in res:
+                stderr.write('%s\n' % (res['error']))
+                exit(1)
+            stdout.write(res['output'])
+            exit()
+
+    res = main(
+        args.defaults, args.settings,
+        config=args.config, verbose=args.verbose,
+        paths=args.paths, find=args.find,
+        overrides=args.overrides, provenance=args.provenance,
+        batch=args.batch, prefix=args.prefix
     )
+    if args.batch:
+        stdout.write(res)
+        exit()
+
+    from photon.util.formatters import fmt
+
+    fmt(res, args.formatter)
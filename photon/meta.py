@@ -1,12 +1,532 @@
-from random import randint as _randint
-from threading import Lock
+from atexit import register as _register
+from collections import OrderedDict as _OrderedDict
+from collections import deque as _deque
+from copy import deepcopy as _deepcopy
+from hashlib import sha1 as _sha1
+from itertools import count as _count
+from json import dumps as _dumps
+from os import getpid as _getpid
+from os import path as _path
+from os import remove as _remove
+from random import getrandbits as _getrandbits
+from re import compile as _compile
+from threading import Condition, Lock, Thread
+from time import monotonic as _monotonic
+from time import monotonic_ns as _monotonic_ns
+from time import time as _time
 
 from photon import IDENT
 
-from photon.util.files import read_json, write_json
+from photon.metadb import MetaDB, is_database
+from photon.util.files import append_json, iter_json, iter_json_lines, \
+    lock_file, read_json, read_json_lines, write_json
 from photon.util.locations import search_location
-from photon.util.structures import dict_merge
-from photon.util.system import get_timestamp, shell_notify
+from photon.util.structures import dict_merge, dict_merge_shared
+from photon.util.system import get_timestamp, parse_timestamp, shell_notify
+
+BACKENDS = {
+    'sqlite': MetaDB
+}
+
+_SEQUENCE = _count(1)
+
+STAMPS = ['seq', 'time', 'elapsed']
+'''
+Fields added to each log entry by :attr:`Meta.log`,
+they are not considered by :func:`entry_shape`
+'''
+
+VARYING = 10
+'''
+How many of the values of each varying field
+are kept by :func:`coalesce_entry`
+'''
+
+
+def entry_time(key, elem):
+    '''
+    :param key:
+        The key of a log entry
+    :param elem:
+        The log entry
+    :returns:
+        The wall-clock time of the log entry in seconds since the epoch.
+        Taken from it's 'time' field, entries written before
+        there was one are parsed from their timestamp `key`
+    '''
+
+    if isinstance(elem, dict) and isinstance(elem.get('time'), (int, float)):
+        return elem['time']
+    return parse_timestamp(key)
+
+
+def journal_name(stage):
+    '''
+    :param stage:
+        The full path of a stage file
+    :returns:
+        The full path of the journal belonging to `stage`
+        (the extension is replaced by ``.jsonl``)
+    '''
+
+    return '%s.jsonl' % (_path.splitext(stage)[0])
+
+
+def lock_name(stage):
+    '''
+    :param stage:
+        The full path of a stage file
+    :returns:
+        The full path of the lock file belonging to `stage`
+        (used in `shared` mode of :class:`Meta`)
+    '''
+
+    return '%s.lock' % (_path.splitext(stage)[0])
+
+
+def segment_name(stage, num):
+    '''
+    :param stage:
+        The full path of a stage file
+    :param num:
+        The number of the segment
+    :returns:
+        The full path of segment `num` belonging to `stage`
+    '''
+
+    return '%s.%04d.json' % (_path.splitext(stage)[0], num)
+
+
+def index_name(stage):
+    '''
+    :param stage:
+        The full path of a stage file
+    :returns:
+        The full path of the segment index belonging to `stage`
+    '''
+
+    return '%s.index.json' % (_path.splitext(stage)[0])
+
+
+def read_index(stage):
+    '''
+    Reads segment indices
+
+    :param stage:
+        The full path of a stage file
+    :returns:
+        The segment index of `stage` (see :func:`index_name`).
+        A dictionary with a list of all 'segments' in order,
+        each with it's 'num', 'file', count of 'entries',
+        and the 'first' and 'last' key
+    '''
+
+    i = read_json(index_name(stage))
+    if not i or not isinstance(i, dict):
+        i = dict()
+    i.setdefault('segments', list())
+    return i
+
+
+def iter_log(stage, resolve=False):
+    '''
+    Iterates through the full log of a stage
+
+    :param stage:
+        The full path of a stage file
+    :param resolve:
+        Rehydrate blob references (see :func:`resolve_blobs`)
+    :returns:
+        A generator yielding pairs of key and log entry, from all
+        segments (see :func:`read_index`), the stage itself and
+        it's journal (see :func:`journal_name`).
+
+        * The files are read incrementally \
+        (see :func:`util.files.iter_json`), \
+        only the current entry is kept in memory
+
+        * Entries from the journal replace earlier ones with the same key \
+        (the last line wins, e.g. for coalesced entries). \
+        So the journal is read up front
+    '''
+
+    if is_database(stage):
+        db = MetaDB(stage)
+        try:
+            for key, elem in db.query():
+                if resolve:
+                    elem = _resolve_db(db, elem)
+                yield key, elem
+        finally:
+            db.close()
+        return
+
+    journal, journal_blobs = dict(), dict()
+    for line in iter_json_lines(journal_name(stage)):
+        journal_blobs.update(line.get('blobs', dict()))
+        for key, val in sorted(line.get('log', dict()).items()):
+            journal[key] = val
+
+    blobs = dict()
+    if resolve:
+        for path, val in iter_json(stage, stream='log'):
+            if path[0] == 'log':
+                break
+            if path[0] == 'blobs':
+                blobs.update(val)
+
+    files = [
+        _path.join(_path.dirname(stage), segment['file'])
+        for segment in read_index(stage)['segments']
+    ] + [stage]
+    for f in files:
+        for path, val in iter_json(f, stream='log'):
+            if path[0] == 'blobs' and len(path) == 1:
+                blobs.update(val)
+            elif path[0] == 'log' and len(path) == 2 and (
+                path[1] not in journal
+            ):
+                yield path[1], resolve_blobs(val, blobs) if resolve else val
+
+    blobs.update(journal_blobs)
+    for key, val in journal.items():
+        yield key, resolve_blobs(val, blobs) if resolve else val
+
+
+def read_header(stage):
+    '''
+    :param stage:
+        The full path of a stage file
+    :returns:
+        Only the header of the stage, without reading the rest of it
+    '''
+
+    if is_database(stage):
+        return read_meta(stage).get('header')
+    for path, val in iter_json(stage, stream='log'):
+        if path == ('header',):
+            return val
+
+
+def filter_log(entries, since=None, until=None, message=None,
+               failed=None, command=None):
+    '''
+    Filters log entries
+
+    :param entries:
+        Pairs of key and log entry (e.g. from :func:`iter_log`)
+    :param since:
+        Only entries from `since` on
+    :param until:
+        Only entries up to `until`
+
+        * Both as seconds since the epoch, or as string like \
+        :func:`util.system.get_timestamp` returns \
+        (see :func:`entry_time`)
+
+    :param message:
+        Only entries whose message matches this regular expression
+    :param failed:
+        Only failed (``True``) or not failed (``False``) entries
+    :param command:
+        Only entries whose command contains this string
+    :returns:
+        A generator yielding the matching pairs
+    '''
+
+    if isinstance(since, str):
+        since = parse_timestamp(since)
+    if isinstance(until, str):
+        until = parse_timestamp(until)
+    if message is not None:
+        message = _compile(message)
+
+    for key, elem in entries:
+        if since is not None or until is not None:
+            t = entry_time(key, elem)
+            if t is None or (
+                since is not None and t < since
+            ) or (
+                until is not None and t > until
+            ):
+                continue
+        e = elem if isinstance(elem, dict) else dict()
+        more = e.get('more') if isinstance(e.get('more'), dict) else dict()
+        if message is not None and not message.search(
+            str(e.get('message', ''))
+        ):
+            continue
+        if failed is not None and bool(failed) != _failed(elem):
+            continue
+        if command is not None and command not in str(
+            more.get('command', '')
+        ):
+            continue
+        yield key, elem
+
+
+def _leaves(obj, prefix=''):
+    res = dict()
+    for key, val in obj.items():
+        path = '%s%s' % (prefix, key)
+        if isinstance(val, dict) and val:
+            res.update(_leaves(val, prefix='%s.' % (path)))
+        else:
+            res[path] = val
+    return res
+
+
+def _structure(obj):
+    if isinstance(obj, dict):
+        return dict((key, _structure(val)) for key, val in obj.items())
+
+
+def entry_shape(elem):
+    '''
+    :param elem:
+        A log entry
+    :returns:
+        A string describing the shape of `elem`: It's message,
+        failed state and the structure of it's keys (but not their values).
+        Fields from :data:`STAMPS` are left out
+    '''
+
+    e = elem if isinstance(elem, dict) else dict(elem=elem)
+    return _dumps([
+        e.get('message'),
+        _failed(e),
+        _structure(dict(
+            (key, val) for key, val in e.items()
+            if key not in STAMPS and key != 'coalesced'
+        ))
+    ], sort_keys=True, default=str)
+
+
+def coalesce_entry(record, elem):
+    '''
+    Merges a log entry into another one of the same shape
+    (see :func:`entry_shape`)
+
+    :param record:
+        The log entry to merge into (only the lists of values
+        in it's 'varying' field are updated in place)
+    :param elem:
+        The log entry to merge
+    :returns:
+        A copy of `record` with a 'coalesced' field added (or updated):
+
+        * 'count': How many entries were merged
+
+        * 'first', 'last': The 'time' of the first and last entry
+
+        * 'varying': The fields (as dotted path) which differ between \
+        the entries, with a list of their last values in order \
+        (at most :data:`VARYING`)
+
+        All other fields are taken from the first entry
+    '''
+
+    info = record.get('coalesced') or dict(
+        count=1, first=record.get('time'), last=record.get('time'),
+        varying=dict()
+    )
+    base = _leaves(dict(
+        (key, val) for key, val in record.items()
+        if key not in STAMPS and key != 'coalesced'
+    ))
+    varying = dict(info['varying'])
+    for path, val in _leaves(dict(
+        (key, val) for key, val in elem.items() if key not in STAMPS
+    )).items():
+        if path in varying:
+            varying[path].append(val)
+            del varying[path][:-VARYING]
+        elif val != base.get(path):
+            varying[path] = [base.get(path)] * min(
+                info['count'], VARYING - 1
+            ) + [val]
+
+    return dict(record, coalesced=dict(
+        count=info['count'] + 1, first=info['first'],
+        last=elem.get('time'), varying=varying
+    ))
+
+
+def compact_segments(stage, drop_verbose=False, durability='none'):
+    '''
+    Merges all segments of a stage into one single new segment
+
+    :param stage:
+        The full path of a stage file
+    :param drop_verbose:
+        Skip entries which were logged with `verbose` set to ``False``
+        (unless they failed, like the `failed` filter of :func:`filter_log`)
+    :param durability:
+        Pass `durability` down to :func:`util.files.write_file`
+    :returns:
+        The new segment index (see :func:`read_index`)
+    '''
+
+    index = read_index(stage)
+    if not index['segments']:
+        return index
+
+    log = dict()
+    for segment in index['segments']:
+        s = read_json(_path.join(_path.dirname(stage), segment['file']))
+        if s and isinstance(s, dict):
+            log.update(s.get('log', dict()))
+    if drop_verbose:
+        for key in [k for k, v in log.items() if _verbose_only(v)]:
+            del log[key]
+
+    old = index['segments']
+    num = max(s.get('num', 0) for s in old) + 1
+    index['segments'] = [
+        _write_segment(stage, num, log, durability=durability)
+    ] if log else []
+    write_json(index_name(stage), index, durability=durability)
+    for segment in old:
+        sfile = _path.join(_path.dirname(stage), segment['file'])
+        if _path.exists(sfile):
+            _remove(sfile)
+    return index
+
+
+def _failed(elem):
+    more = elem.get('more') if isinstance(elem, dict) else None
+    if not isinstance(more, dict):
+        return False
+    return bool(more.get('failed') or more.get('returncode') not in [None, 0])
+
+
+def _verbose_only(elem):
+    if not isinstance(elem, dict) or elem.get('verbose') is not False:
+        return False
+    return not _failed(elem)
+
+
+def _write_segment(stage, num, log, durability='none'):
+    sfile = segment_name(stage, num)
+    write_json(sfile, dict(log=log), durability=durability)
+    keys = sorted(log)
+    return dict(
+        num=num, file=_path.basename(sfile), entries=len(keys),
+        first=keys[0] if keys else None, last=keys[-1] if keys else None
+    )
+
+
+def resolve_blobs(obj, blobs):
+    '''
+    Rehydrates references to blobs (see `blob_size` of :class:`Meta`)
+
+    :param obj:
+        Some content of a meta (e.g. a log entry, or the whole meta)
+    :param blobs:
+        The 'blobs' of the meta
+    :returns:
+        A copy of `obj`, with all references replaced by their content
+    '''
+
+    if isinstance(obj, dict):
+        if len(obj) == 1 and obj.get('$blob') in blobs:
+            return resolve_blobs(blobs[obj['$blob']], blobs)
+        return dict((k, resolve_blobs(v, blobs)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [resolve_blobs(o, blobs) for o in obj]
+    return obj
+
+
+def _resolve_db(db, obj):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and '$blob' in obj:
+            return _resolve_db(db, db.blob(obj['$blob']))
+        return dict((k, _resolve_db(db, v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [_resolve_db(db, o) for o in obj]
+    return obj
+
+
+def read_meta(filename, resolve=False):
+    '''
+    Reads meta files
+
+    :param filename:
+        The full path to the stage file
+    :param resolve:
+        Rehydrate blob references (see :func:`resolve_blobs`)
+    :returns:
+        The content of the stage file with all entries of its
+        journal (see :func:`journal_name`) replayed on top.
+        SQLite databases (see :class:`metadb.MetaDB`) are read as well
+    '''
+
+    if is_database(filename):
+        db = MetaDB(filename)
+        j = db.read()
+        db.close()
+    else:
+        j = _read_stage(filename)
+    if resolve and isinstance(j, dict) and j.get('blobs'):
+        j = dict(resolve_blobs(j, j['blobs']), blobs=j['blobs'])
+    return j
+
+
+def _read_stage(filename):
+    j = read_json(filename)
+    for line in read_json_lines(journal_name(filename)):
+        if not isinstance(j, dict):
+            j = dict()
+        for key, val in line.items():
+            if isinstance(val, dict):
+                j.setdefault(key, dict()).update(val)
+            else:
+                j[key] = val
+    return j
+
+
+class LogWindow(dict):
+    '''
+    The log of :class:`Meta` when only a window of it is kept in memory.
+
+    It behaves like a plain dictionary containing the most recent
+    log entries. Use :meth:`history` to get all of it.
+
+    :param stage:
+        The full path of the stage file the log is written into
+    :param flush:
+        Function to call before reading from disk
+        (usually :meth:`Meta.flush`)
+    '''
+
+    def __init__(self, *args, stage=None, flush=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.stage = stage
+        self.flush = flush
+
+    def __deepcopy__(self, memo):
+        return LogWindow(
+            _deepcopy(dict(self), memo), stage=self.stage, flush=self.flush
+        )
+
+    def history(self):
+        '''
+        :returns:
+            A generator yielding pairs of key and log entry of the
+            full log, read lazily from disk (see :func:`iter_log`),
+            followed by entries in memory not yet written to disk
+        '''
+
+        if self.flush:
+            self.flush()
+        remaining = set(self.keys())
+        if self.stage:
+            for key, elem in iter_log(self.stage):
+                remaining.discard(key)
+                yield key, elem
+        for key in [k for k in self.keys() if k in remaining]:
+            yield key, self[key]
 
 
 class Meta(object):
@@ -22,24 +542,160 @@ class Meta(object):
         Initial, clean meta file to use. See :meth:`stage` for more
     :param verbose:
         Sets the `verbose` flag for the underlying :ref:`util` functions
+    :param journal:
+        Append each new log entry as a single line to the journal
+        of the stage (see :func:`journal_name`) instead of rewriting
+        the whole stage file every time.
+
+        * The full stage file is only written on changes of the \
+        header or imports, on :meth:`snapshot` and at shutdown
+
+        * :meth:`load` replays the journal, so nothing gets lost
+    :param flush_interval:
+        Do not write new log entries on the caller's thread,
+        instead queue them up for a background writer,
+        which flushes them every `flush_interval` seconds
+    :param flush_count:
+        Like `flush_interval`, but flushes as soon as
+        `flush_count` log entries are queued up.
+
+        * Both can be combined, whichever comes first triggers
+
+        * Use :meth:`flush` or :meth:`close` to write explicitly. \
+        :meth:`close` is called at shutdown anyway
+    :param segment_size:
+        Roll the log of the stage into a new numbered segment file
+        (see :func:`segment_name`), as soon as it's log entries exceed
+        `segment_size` bytes
+    :param segment_entries:
+        Like `segment_size`, but rolls after `segment_entries` log entries.
+
+        * The stage file itself only carries the log entries of the \
+        current segment, so the cost of each write stays bounded
+
+        * The segments are listed in an index file \
+        (see :func:`read_index`). Use :func:`iter_log` to read all of it
+
+        * Use :meth:`compact` to merge the segments later on
+    :param window_entries:
+        Only keep the last `window_entries` log entries in memory
+    :param window_seconds:
+        Only keep the log entries of the last `window_seconds` in memory.
+
+        * Older entries are only kept on disk, so this implies `journal`
+
+        * The log is then a :class:`LogWindow`, \
+        use it's :meth:`LogWindow.history` to read all of it
+    :param backend:
+        Store the meta somewhere else than in a json-file.
+        Choose a key from :data:`BACKENDS`:
+
+        * ``'sqlite'``: The stage is a SQLite database \
+        (see :class:`metadb.MetaDB`). Each log entry is inserted as a \
+        single row, `journal` and `segment_*` are ignored
+    :param shared:
+        Allow several processes to log into the same stage concurrently.
+
+        * Implies `journal`, each batch of log entries is appended \
+        while holding an advisory lock (see :func:`lock_name`)
+
+        * :meth:`snapshot` merges the entries of all other processes \
+        into the stage file, so there are no lost updates
+
+        * `clean` in :meth:`stage` does not throw away \
+        the entries of other processes, `segment_*` are ignored
+    :param durability:
+        Pass `durability` down to :func:`util.files.write_file`.
+        Meta is written often, so it defaults to ``'none'``
+    :param blob_size:
+        Store the `more` payloads of log entries and imported data
+        only once in 'blobs' of the meta, when they are at least
+        `blob_size` bytes large.
+
+        * They are referenced by their digest \
+        (like ``{'$blob': '<sha1>'}``)
+
+        * Use :meth:`resolve` (or :func:`resolve_blobs`) to rehydrate them
+    :param coalesce:
+        Merge new log entries into a previous one of the same shape
+        (see :func:`entry_shape`), instead of adding a new entry.
+
+        * ``True``: Only consecutive entries are merged
+
+        * A number: Merge with any of the last `coalesce` different shapes
+
+        * The merged entry keeps it's key, and gets a 'coalesced' field \
+        (see :func:`coalesce_entry`). In `journal` mode it is only \
+        appended again once it is closed (when another shape takes over) \
+        or on :meth:`flush`, which closes it as well. The last line wins
     '''
-    def __init__(self, meta='meta.json', verbose=True):
+    def __init__(self, meta='meta.json', verbose=True, journal=False,
+                 flush_interval=None, flush_count=None,
+                 segment_size=None, segment_entries=None,
+                 window_entries=None, window_seconds=None,
+                 backend=None, shared=False, durability='none',
+                 blob_size=None, coalesce=None):
 
         super().__init__()
 
         self.__verbose = verbose
+        self.__journal = journal or shared or bool(
+            window_entries or window_seconds
+        )
+        self.__shared = shared
+        self.__durability = durability
+        self.__blob_size = blob_size
+        self.__blobs = dict()
+        self.__coalesce = 1 if coalesce is True else coalesce
+        self.__recent = _OrderedDict()
+        self.__open = dict()
+        self.__flush_interval = flush_interval
+        self.__flush_count = flush_count
+        self.__segment_size = segment_size
+        self.__segment_entries = segment_entries
+        self.__active = dict() if (
+            segment_size or segment_entries
+        ) and not shared else None
+        self.__active_size = 0
+        self.__window_entries = window_entries
+        self.__window_seconds = window_seconds
+        self.__window = _deque() if window_entries or window_seconds else None
+        self.__ident = '%s-%d-%012X' % (IDENT, _getpid(), _getrandbits(48))
+        self.__started = _monotonic_ns()
         self.__meta = {
             'header': {
-                'ident': '%s-%4X' % (IDENT, _randint(0x1000, 0xffff)),
+                'ident': self.__ident,
                 'initialized': get_timestamp(),
                 'verbose': verbose
             },
             'import': dict(),
-            'log': dict()
+            'blobs': dict(),
+            'log': LogWindow(
+                flush=self.flush
+            ) if self.__window is not None else dict()
         }
+        if not blob_size:
+            del self.__meta['blobs']
         self.__lock = Lock()
+        self.__queue = Condition()
+        self.__pending = list()
+        self.__dirty = True
+        self.__clean = True
+        self.__closed = False
+        self.__writer = None
+        self.__backend = BACKENDS[backend] if backend else None
+        self.__db = None
         self.stage(meta, clean=True)
 
+        if flush_interval or flush_count:
+            self.__writer = Thread(
+                target=self.__write_loop, name='%s meta writer' % (IDENT)
+            )
+            self.__writer.daemon = True
+            self.__writer.start()
+        if self.__journal or self.__writer or self.__db:
+            _register(self.close)
+
     def stage(self, name, clean=False):
         '''
         Switch stage
@@ -59,10 +715,40 @@ class Meta(object):
         '''
 
         name = search_location(name, create_in='data_dir')
+        if (
+            self.__journal or self.__db
+        ) and self.__meta['header'].get('stage'):
+            self.snapshot()
+        if self.__backend:
+            self.__lock.acquire()
+            try:
+                if self.__db:
+                    self.__db.close()
+                self.__db = self.__backend(name)
+                if clean:
+                    self.__db.clear()
+            finally:
+                self.__lock.release()
+        if clean and not self.__shared and _path.exists(index_name(name)):
+            for segment in read_index(name)['segments']:
+                sfile = _path.join(_path.dirname(name), segment['file'])
+                if _path.exists(sfile):
+                    _remove(sfile)
+            _remove(index_name(name))
         if not clean:
             self.load('stage', name, merge=True)
 
-        self.__meta['header'].update({'stage': name})
+        self.__queue.acquire()
+        try:
+            self.__close(list(self.__open))
+            self.__recent.clear()
+            self.__meta['header'].update({'stage': name})
+            if isinstance(self.__meta['log'], LogWindow):
+                self.__meta['log'].stage = name
+            self.__dirty = True
+            self.__clean = clean
+        finally:
+            self.__queue.release()
         self.log = shell_notify(
             '%s stage' % ('new clean' if clean else 'loaded'),
             more=dict(meta=name, clean=clean),
@@ -90,13 +776,23 @@ class Meta(object):
             The loaded (or directly passed) content
         '''
 
-        j = mdict if mdict else read_json(mdesc)
+        j = mdict if mdict else read_meta(mdesc)
         if j and isinstance(j, dict):
-            self.__meta['header'].update({mkey: mdesc})
-            if merge:
-                self.__meta = dict_merge(self.__meta, j)
-            else:
-                self.__meta['import'][mkey] = j
+            self.__queue.acquire()
+            try:
+                self.__meta['header'].update({mkey: mdesc})
+                self.__dirty = True
+                if merge:
+                    self.__meta = (
+                        dict_merge if mdict else dict_merge_shared
+                    )(self.__meta, j)
+                    if self.__active is not None:
+                        self.__active.update(j.get('log', dict()))
+                    self.__trim(j.get('log', dict()).keys())
+                else:
+                    self.__meta['import'][mkey] = self.__blob(j)
+            finally:
+                self.__queue.release()
             self.log = shell_notify(
                 'load %s data and %s it into meta' % (
                     'got' if mdict else 'read',
@@ -107,18 +803,55 @@ class Meta(object):
             )
         return j
 
+    def resolve(self, obj=None):
+        '''
+        :param obj:
+            Something with blob references, from the current meta
+        :returns:
+            A copy of `obj` (or the whole meta if left to ``None``)
+            with all blobs rehydrated (see :func:`resolve_blobs`)
+        '''
+
+        if obj is None:
+            obj = self.__meta
+        return resolve_blobs(obj, self.__meta.get('blobs', dict()))
+
+    @property
+    def db(self):
+        '''
+        :returns:
+            The database of the current stage (see :class:`metadb.MetaDB`)
+            if a `backend` is in use. Use it for queries
+        '''
+
+        return self.__db
+
     @property
     def log(self):
         '''
         :param elem: Add a new log entry to the meta.
 
-            * Can be anything.
+            * Can be anything. Dictionaries (like the ones from \
+            :func:`util.system.shell_notify`) are extended by the \
+            fields below, anything else is placed under 'elem'
+
+            * 'seq': A sequence number, counting up within the process
+
+            * 'time': The wall-clock time (seconds since the epoch)
+
+            * 'elapsed': Nanoseconds since the meta was initialized \
+            (from :py:func:`time.monotonic_ns`)
 
-            * The log is a dictionary with keys \
-            generated from the output of :func:`util.system.get_timestamp` \
-            and `elem` as value
+            * The log is a dictionary with keys generated from \
+            the `ident` in the header and the zero-padded 'seq' \
+            (e.g. ``photon-4242-1A2B3C4D5E6F-00000042``). \
+            The `ident` holds the process id and 48 random bits, \
+            so the keys of different runs do not collide, \
+            even when they share a stage
 
         :returns: Current meta
+
+        .. seealso:: :func:`entry_time`
         '''
 
         return self.__meta
@@ -129,14 +862,316 @@ class Meta(object):
         .. seealso:: :attr:`log`
         '''
 
+        key = None
         if elem:
-            self.__meta['log'].update({get_timestamp(precice=True): elem})
-        mfile = self.__meta['header']['stage']
+            seq = next(_SEQUENCE)
+            key = '%s-%08d' % (self.__ident, seq)
+            elem = dict(
+                elem if isinstance(elem, dict) else dict(elem=elem),
+                seq=seq, time=_time(),
+                elapsed=_monotonic_ns() - self.__started
+            )
+
+        self.__queue.acquire()
+        try:
+            if key:
+                key, elem, new = self.__coalesced(key, elem)
+                if self.__blob_size and elem.get('more'):
+                    elem = dict(elem, more=self.__blob(elem['more']))
+                self.__meta['log'].update({key: elem})
+                if new:
+                    self.__pending.append((key, elem))
+                else:
+                    self.__open[key] = elem
+                if self.__active is not None:
+                    self.__active.update({key: elem})
+                if new:
+                    self.__trim([key])
+            if self.__writer and not self.__closed:
+                if (
+                    self.__flush_count and
+                    len(self.__pending) >= self.__flush_count
+                ):
+                    self.__queue.notify()
+                return
+        finally:
+            self.__queue.release()
+
+        self.__flush()
+
+    def flush(self):
+        '''
+        Writes all queued up log entries to disk.
+
+        * Either appended to the journal in `journal` mode
+
+        * Or by writing the full meta (see :meth:`snapshot`)
 
+        * Entries being coalesced are closed and written as well
+        '''
+
+        self.__flush(close=True)
+
+    def __flush(self, close=False):
         self.__lock.acquire()
         try:
-            j = read_json(mfile)
-            if j != self.__meta:
-                write_json(mfile, self.__meta)
+            self.__queue.acquire()
+            try:
+                if close:
+                    self.__close(list(self.__open))
+                entries = dict(self.__pending)
+                self.__pending = list()
+                blobs, self.__blobs = self.__blobs, dict()
+                full = self.__dirty or not (self.__journal or self.__db)
+            finally:
+                self.__queue.release()
+
+            if self.__segment_due(entries):
+                self.__roll()
+                full = True
+            if full:
+                self.__snapshot()
+            elif entries and self.__db:
+                self.__db.append(self.__ident, entries, blobs=blobs)
+            elif entries:
+                line = dict(log=entries, blobs=blobs) if blobs else dict(
+                    log=entries
+                )
+                stage = self.__meta['header']['stage']
+                if self.__shared:
+                    with lock_file(lock_name(stage)):
+                        append_json(journal_name(stage), line)
+                else:
+                    append_json(journal_name(stage), line)
+        finally:
+            self.__lock.release()
+
+    def compact(self, drop_verbose=False):
+        '''
+        Merges the segments of the current stage
+
+        :param drop_verbose:
+            Pass `drop_verbose` down to :func:`compact_segments`
+        :returns:
+            The new segment index
+        '''
+
+        self.__lock.acquire()
+        try:
+            return compact_segments(
+                self.__meta['header']['stage'],
+                drop_verbose=drop_verbose, durability=self.__durability
+            )
         finally:
             self.__lock.release()
+
+    def snapshot(self):
+        '''
+        Writes the full meta into the stage file.
+
+        In `journal` mode, the journal gets removed afterwards,
+        because all of it's entries are now contained in the stage file.
+        '''
+
+        self.__lock.acquire()
+        try:
+            self.__snapshot()
+        finally:
+            self.__lock.release()
+
+    def close(self):
+        '''
+        Stops the background writer (if any), and writes everything
+        left to disk. In `journal` mode a :meth:`snapshot` is written.
+
+        Gets called at shutdown, when either `journal`, `flush_interval`
+        or `flush_count` is set.
+        '''
+
+        self.__queue.acquire()
+        try:
+            self.__closed = True
+            self.__queue.notify()
+        finally:
+            self.__queue.release()
+
+        if self.__writer and self.__writer.is_alive():
+            self.__writer.join()
+        if self.__journal or self.__db:
+            self.snapshot()
+        else:
+            self.flush()
+
+    def __snapshot(self):
+        self.__queue.acquire()
+        try:
+            meta = dict(
+                (key, dict(val) if isinstance(val, dict) else val)
+                for key, val in self.__meta.items()
+            )
+            if self.__active is not None:
+                meta['log'] = dict(self.__active)
+            self.__pending = list()
+            self.__open = dict()
+            self.__blobs = dict()
+            self.__dirty = False
+            clean, self.__clean = self.__clean, False
+        finally:
+            self.__queue.release()
+
+        if self.__db:
+            self.__db.write(meta, run=self.__ident)
+            return
+
+        mfile = meta['header']['stage']
+        if self.__shared:
+            with lock_file(lock_name(mfile)):
+                self.__write_stage(mfile, meta, merge=True)
+        else:
+            self.__write_stage(mfile, meta, merge=(
+                self.__window is not None and
+                self.__active is None and
+                not clean
+            ))
+
+    def __write_stage(self, mfile, meta, merge=False):
+        if merge:
+            m = read_meta(mfile)
+            if m and isinstance(m, dict):
+                for key, val in meta.items():
+                    if isinstance(val, dict) and isinstance(m.get(key), dict):
+                        m[key].update(val)
+                    else:
+                        m[key] = val
+                meta = m
+        j = read_json(mfile)
+        if j != meta:
+            write_json(mfile, meta, durability=self.__durability)
+        if self.__journal and _path.exists(journal_name(mfile)):
+            _remove(journal_name(mfile))
+
+    def __coalesced(self, key, elem):
+        if not self.__coalesce:
+            return key, elem, True
+        shape = entry_shape(elem)
+        log = self.__active if self.__active is not None else (
+            self.__meta['log']
+        )
+
+        new = True
+        last = self.__recent.pop(shape, None)
+        if last and last[0] in log:
+            key, elem, new = last[0], coalesce_entry(last[1], elem), False
+        elif last:
+            self.__close([last[0]])
+        self.__recent[shape] = (key, elem)
+        while len(self.__recent) > self.__coalesce:
+            self.__close([self.__recent.popitem(last=False)[1][0]])
+        return key, elem, new
+
+    def __close(self, keys):
+        for key in keys:
+            if key in self.__open:
+                self.__pending.append((key, self.__open.pop(key)))
+            for shape in [
+                s for s, (k, _) in self.__recent.items() if k == key
+            ]:
+                del self.__recent[shape]
+
+    def __blob(self, payload):
+        if not self.__blob_size:
+            return payload
+        content = _dumps(payload, sort_keys=True, default=str)
+        if len(content) < self.__blob_size:
+            return payload
+        digest = _sha1(content.encode('utf-8')).hexdigest()
+
+        self.__queue.acquire()
+        try:
+            if digest not in self.__meta['blobs']:
+                self.__meta['blobs'][digest] = payload
+                self.__blobs[digest] = payload
+        finally:
+            self.__queue.release()
+        return {'$blob': digest}
+
+    def __trim(self, keys):
+        if self.__window is None:
+            return
+        now = _monotonic()
+        self.__window.extend((now, key) for key in keys)
+        while self.__window and (
+            (
+                self.__window_entries and
+                len(self.__window) > self.__window_entries
+            ) or (
+                self.__window_seconds and
+                self.__window[0][0] < now - self.__window_seconds
+            )
+        ):
+            key = self.__window.popleft()[1]
+            self.__close([key])
+            self.__meta['log'].pop(key, None)
+
+    def __segment_due(self, entries):
+        if self.__active is None or self.__db:
+            return False
+        if self.__segment_size and entries:
+            self.__active_size += len(_dumps(entries))
+        return (
+            self.__segment_entries and
+            len(self.__active) >= self.__segment_entries
+        ) or (
+            self.__segment_size and
+            self.__active_size >= self.__segment_size
+        )
+
+    def __roll(self):
+        self.__queue.acquire()
+        try:
+            logs, log, size = list(), dict(), 0
+            for key, elem in self.__active.items():
+                log[key] = elem
+                if self.__segment_size:
+                    size += len(_dumps({key: elem}))
+                if (
+                    self.__segment_entries and
+                    len(log) >= self.__segment_entries
+                ) or (
+                    self.__segment_size and size >= self.__segment_size
+                ):
+                    logs.append(log)
+                    log, size = dict(), 0
+            self.__active, self.__active_size = log, size
+            self.__open = dict()
+            self.__recent.clear()
+            self.__dirty = True
+            stage = self.__meta['header']['stage']
+        finally:
+            self.__queue.release()
+
+        index = read_index(stage)
+        num = max([s.get('num', 0) for s in index['segments']] + [0])
+        for log in logs:
+            num += 1
+            index['segments'].append(
+                _write_segment(stage, num, log, durability=self.__durability)
+            )
+        write_json(index_name(stage), index, durability=self.__durability)
+
+    def __write_loop(self):
+        while True:
+            self.__queue.acquire()
+            try:
+                if not self.__closed and not (
+                    self.__flush_count and
+                    len(self.__pending) >= self.__flush_count
+                ):
+                    self.__queue.wait(self.__flush_interval)
+                closed = self.__closed
+            finally:
+                self.__queue.release()
+
+            self.flush()
+            if closed:
+                break
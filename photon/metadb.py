@@ -0,0 +1,342 @@
+'''
+.. |param_run| replace::
+    Limit to one run (the `ident` from the header of :class:`meta.Meta`).
+    Use ``True`` for the last run
+'''
+
+from json import dumps as _dumps
+from json import loads as _loads
+from os import path as _path
+from re import search as _search
+from sqlite3 import connect as _connect
+from threading import Lock
+
+from photon.util.system import parse_timestamp
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run TEXT UNIQUE,
+        header TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS imports (
+        run TEXT,
+        mkey TEXT,
+        content TEXT,
+        PRIMARY KEY (run, mkey)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS blobs (
+        digest TEXT PRIMARY KEY,
+        content TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS log (
+        key TEXT PRIMARY KEY,
+        run TEXT,
+        time REAL,
+        message TEXT,
+        failed INTEGER,
+        returncode INTEGER,
+        command TEXT,
+        entry TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS log_key ON log (run, key)',
+    'CREATE INDEX IF NOT EXISTS log_time ON log (time)',
+    'CREATE INDEX IF NOT EXISTS log_message ON log (message)',
+    'CREATE INDEX IF NOT EXISTS log_failed ON log (failed, returncode)',
+]
+
+
+def is_database(filename):
+    '''
+    :param filename:
+        The full path of a file
+    :returns:
+        ``True`` if `filename` is a SQLite database
+    '''
+
+    if filename and _path.isfile(filename):
+        with open(filename, 'rb') as f:
+            return f.read(16) == b'SQLite format 3\x00'
+    return False
+
+
+class MetaDB(object):
+    '''
+    MetaDB stores the contents of :class:`meta.Meta` in a SQLite database,
+    as an alternative to the json-file.
+
+    Each log entry is one row, indexed by it's key, time,
+    message and failed state/returncode.
+    This allows queries without loading the whole meta (see :meth:`query`).
+
+    Use it with :class:`meta.Meta` by setting `backend` to ``'sqlite'``.
+
+    :param filename:
+        The full path to the database (gets created if necessary)
+    '''
+
+    def __init__(self, filename):
+        super().__init__()
+
+        self.__filename = filename
+        self.__lock = Lock()
+        self.__db = _connect(filename, check_same_thread=False)
+        self.__db.create_function(
+            'REGEXP', 2,
+            lambda p, v: _search(p, v) is not None if v else False
+        )
+        with self.__db:
+            for s in SCHEMA:
+                self.__db.execute(s)
+
+    @property
+    def filename(self):
+        '''
+        :returns:
+            The full path to the database
+        '''
+
+        return self.__filename
+
+    def clear(self):
+        '''
+        Removes all runs, imports, blobs and log entries
+        '''
+
+        self.__execute([
+            'DELETE FROM %s' % (t) for t in ['runs', 'imports', 'blobs', 'log']
+        ])
+
+    def write(self, meta, log=True, run=None):
+        '''
+        Stores a whole meta
+
+        :param meta:
+            The content of :class:`meta.Meta`
+            (the header, imports and log entries)
+        :param log:
+            Also store the log entries from `meta`
+        :param run:
+            The `ident` of the current run.
+            Taken from the header of `meta` if left to ``None``
+        '''
+
+        if not run:
+            run = meta['header']['ident']
+        self.__execute([(
+            '''INSERT INTO runs (run, header) VALUES (?, ?)
+            ON CONFLICT (run) DO UPDATE SET header = excluded.header''',
+            (run, _dumps(meta['header'], sort_keys=True))
+        )] + [(
+            'INSERT OR REPLACE INTO imports VALUES (?, ?, ?)',
+            (run, mkey, _dumps(content, sort_keys=True))
+        ) for mkey, content in meta.get('import', dict()).items()])
+        if log:
+            self.append(
+                run, meta.get('log', dict()), blobs=meta.get('blobs')
+            )
+
+    def append(self, run, entries, blobs=None):
+        '''
+        Stores log entries
+
+        :param run:
+            The `ident` of the current run
+        :param entries:
+            A dictionary of keys and log entries
+        :param blobs:
+            A dictionary of digests and blobs referenced by `entries`
+        '''
+
+        if blobs:
+            self.__execute([(
+                'INSERT OR IGNORE INTO blobs VALUES (?, ?)',
+                [(d, _dumps(c, sort_keys=True)) for d, c in blobs.items()]
+            )], many=True)
+
+        from photon.meta import _failed, entry_time
+
+        rows = list()
+        for key, elem in entries.items():
+            message = failed = returncode = command = None
+            if isinstance(elem, dict):
+                message = elem.get('message')
+                more = elem.get('more')
+                if isinstance(more, dict) and len(more) == 1 and (
+                    '$blob' in more
+                ):
+                    more = (blobs or dict()).get(more['$blob']) or self.blob(
+                        more['$blob']
+                    )
+                if isinstance(more, dict):
+                    returncode = more.get('returncode')
+                    failed = int(_failed(dict(elem, more=more)))
+                    command = more.get('command')
+            rows.append((
+                key, run, entry_time(key, elem),
+                None if message is None else str(message),
+                failed, returncode,
+                None if command is None else str(command),
+                _dumps(elem, sort_keys=True)
+            ))
+        self.__execute([(
+            'INSERT OR REPLACE INTO log VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows
+        )], many=True)
+
+    def runs(self):
+        '''
+        :returns:
+            A list of all run `idents`, in order of appearance
+        '''
+
+        return [r[0] for r in self.__fetch(
+            'SELECT run FROM runs ORDER BY id', tuple()
+        )]
+
+    @property
+    def last_run(self):
+        '''
+        :returns:
+            The `ident` of the last run (or ``None``)
+        '''
+
+        r = self.__fetch(
+            'SELECT run FROM runs ORDER BY id DESC LIMIT 1', tuple()
+        )
+        return r[0][0] if r else None
+
+    def query(self, run=None, message=None, match=None, failed=None,
+              returncode=None, command=None, since=None, until=None,
+              limit=None):
+        '''
+        Searches log entries
+
+        :param run:
+            |param_run|
+        :param message:
+            Only entries with exactly this message
+        :param match:
+            Only entries whose message matches this regular expression
+        :param failed:
+            Only failed (``True``) or not failed (``False``) entries
+        :param returncode:
+            Only entries with this returncode
+        :param command:
+            Only entries which ran this command
+        :param since:
+            Only entries from `since` on
+        :param until:
+            Only entries up to `until`
+
+            * Both as seconds since the epoch, or as string like \
+            :func:`util.system.get_timestamp` returns
+        :param limit:
+            Return not more than `limit` entries
+        :returns:
+            A generator yielding pairs of key and log entry, ordered by time
+        '''
+
+        if run is True:
+            run = self.last_run
+        if isinstance(since, str):
+            since = parse_timestamp(since)
+        if isinstance(until, str):
+            until = parse_timestamp(until)
+        where, args = list(), list()
+        for column, op, value in [
+            ('run', '=', run),
+            ('message', '=', message),
+            ('message', 'REGEXP', match),
+            ('failed', '=', None if failed is None else int(bool(failed))),
+            ('returncode', '=', returncode),
+            ('command', '=', command),
+            ('time', '>=', since),
+            ('time', '<=', until),
+        ]:
+            if value is not None:
+                where.append('%s %s ?' % (column, op))
+                args.append(value)
+
+        sql = 'SELECT key, entry FROM log'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY time, key'
+        if limit:
+            sql += ' LIMIT %d' % (int(limit))
+        for key, entry in self.__fetch(sql, tuple(args)):
+            yield key, _loads(entry)
+
+    def read(self):
+        '''
+        :returns:
+            The whole content in the structure of :class:`meta.Meta`
+            (the header of the last run, imports of all runs and
+            all log entries)
+        '''
+
+        res = dict(header=dict(), log=dict())
+        r = self.__fetch(
+            'SELECT header FROM runs ORDER BY id DESC LIMIT 1', tuple()
+        )
+        if r:
+            res['header'] = _loads(r[0][0])
+        res['import'] = dict(
+            (mkey, _loads(content)) for mkey, content in self.__fetch(
+                '''SELECT mkey, content FROM imports
+                JOIN runs USING (run) ORDER BY runs.id''', tuple()
+            )
+        )
+        blobs = dict(
+            (digest, _loads(content)) for digest, content in self.__fetch(
+                'SELECT digest, content FROM blobs', tuple()
+            )
+        )
+        if blobs:
+            res['blobs'] = blobs
+        res['log'].update(self.query())
+        return res
+
+    def blob(self, digest):
+        '''
+        :param digest:
+            The digest of a blob
+        :returns:
+            The content of the blob (or ``None``)
+        '''
+
+        r = self.__fetch(
+            'SELECT content FROM blobs WHERE digest = ?', (digest,)
+        )
+        return _loads(r[0][0]) if r else None
+
+    def close(self):
+        '''
+        Closes the database
+        '''
+
+        self.__lock.acquire()
+        try:
+            self.__db.close()
+        finally:
+            self.__lock.release()
+
+    def __execute(self, statements, many=False):
+        self.__lock.acquire()
+        try:
+            with self.__db:
+                for s in statements:
+                    if isinstance(s, str):
+                        s = (s, tuple())
+                    if many:
+                        self.__db.executemany(*s)
+                    else:
+                        self.__db.execute(*s)
+        finally:
+            self.__lock.release()
+
+    def __fetch(self, sql, args):
+        self.__lock.acquire()
+        try:
+            return self.__db.execute(sql, args).fetchall()
+        finally:
+            self.__lock.release()
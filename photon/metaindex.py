@@ -0,0 +1,374 @@
+'''
+.. |param_since_until| replace::
+    Seconds since the epoch, or as string like
+    :func:`util.system.get_timestamp` returns
+'''
+
+from os import listdir as _listdir
+from os import path as _path
+from os import stat as _stat
+from re import search as _search
+from sqlite3 import connect as _connect
+from threading import Lock
+
+from photon.meta import _failed, entry_time, index_name, iter_log, \
+    journal_name, read_header
+from photon.metadb import is_database
+from photon.util.locations import get_locations
+from photon.util.system import parse_timestamp
+
+INDEX = 'photon_index.db'
+'''
+Filename of the index, within 'data_dir' from
+:func:`util.locations.get_locations`
+'''
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        fingerprint TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS others (
+        path TEXT PRIMARY KEY,
+        fingerprint TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS runs (
+        path TEXT,
+        run TEXT,
+        first REAL,
+        last REAL,
+        entries INTEGER,
+        failures INTEGER,
+        PRIMARY KEY (path, run)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS entries (
+        path TEXT,
+        run TEXT,
+        key TEXT,
+        time REAL,
+        message TEXT,
+        command TEXT,
+        returncode INTEGER,
+        failed INTEGER,
+        duration REAL,
+        PRIMARY KEY (path, key)
+    )''',
+    'CREATE INDEX IF NOT EXISTS entries_time ON entries (time)',
+    'CREATE INDEX IF NOT EXISTS entries_command ON entries (command, failed)',
+    'CREATE INDEX IF NOT EXISTS entries_failed ON entries (failed, time)',
+]
+
+
+def _stage_files(stage):
+    return [stage, journal_name(stage), index_name(stage)]
+
+
+def _fingerprint(stage):
+    res = list()
+    for f in _stage_files(stage):
+        if _path.exists(f):
+            s = _stat(f)
+            res.append('%d:%d' % (s.st_mtime_ns, s.st_size))
+        else:
+            res.append('-')
+    return '/'.join(res)
+
+
+def _is_stage(filename):
+    name = _path.basename(filename)
+    if name == INDEX or _search(r'\.(\d{4}|index)\.json$', name):
+        return False
+    if name.endswith('.json'):
+        try:
+            return isinstance(read_header(filename), dict)
+        except ValueError:
+            return False
+    if is_database(filename):
+        db = _connect('file:%s?mode=ro' % (filename), uri=True)
+        try:
+            return {'runs', 'log'} <= set(r[0] for r in db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            ))
+        finally:
+            db.close()
+    return False
+
+
+class MetaIndex(object):
+    '''
+    MetaIndex keeps track of all stage files written by :class:`meta.Meta`
+    within a folder, in a persistent SQLite index.
+
+    It holds the runs, and each log entry's message, command, returncode,
+    failed state and duration. So questions like *"when did this command
+    fail the last time?"* can be answered without opening each stage.
+
+    :param location:
+        The folder to index. Uses 'data_dir' from
+        :func:`util.locations.get_locations` if left to ``None``
+    :param filename:
+        Where to store the index.
+        Uses :data:`INDEX` within `location` if left to ``None``
+    '''
+
+    def __init__(self, location=None, filename=None):
+        super().__init__()
+
+        if not location:
+            location = get_locations()['data_dir']
+        if not filename:
+            filename = _path.join(location, INDEX)
+
+        self.__location = location
+        self.__filename = _path.abspath(filename)
+        self.__lock = Lock()
+        self.__db = _connect(filename, check_same_thread=False)
+        self.__db.create_function(
+            'REGEXP', 2,
+            lambda p, v: _search(p, v) is not None if v else False
+        )
+        with self.__db:
+            for s in SCHEMA:
+                self.__db.execute(s)
+
+    @property
+    def location(self):
+        '''
+        :returns:
+            The indexed folder
+        '''
+
+        return self.__location
+
+    def scan(self):
+        '''
+        Updates the index.
+
+        Only files which are new or changed since the last scan
+        (by modification time and size of the stage, it's journal and
+        segment index) are read. Files which turned out not to be stages
+        (or could not be read) are remembered as well, and only looked at
+        again when they change. Stages which are gone get dropped.
+
+        :returns:
+            A dictionary with lists of the stages 'updated' and 'removed'
+        '''
+
+        res = dict(updated=list(), removed=list())
+        known = dict(self.__fetch('SELECT path, fingerprint FROM files'))
+        others = dict(self.__fetch('SELECT path, fingerprint FROM others'))
+        found, seen = set(), set()
+
+        if _path.isdir(self.__location):
+            for name in sorted(_listdir(self.__location)):
+                stage = _path.join(self.__location, name)
+                if not _path.isfile(stage) or (
+                    _path.abspath(stage) == self.__filename
+                ):
+                    continue
+                fingerprint = _fingerprint(stage)
+                if known.get(stage) == fingerprint:
+                    found.add(stage)
+                    continue
+                if others.get(stage) == fingerprint:
+                    seen.add(stage)
+                    continue
+                try:
+                    if _is_stage(stage):
+                        self.__index(stage, fingerprint)
+                        found.add(stage)
+                        res['updated'].append(stage)
+                        continue
+                except ValueError:
+                    pass
+                self.__other(stage, fingerprint)
+                seen.add(stage)
+
+        for stage in sorted(set(known) - found):
+            self.__drop(stage)
+            res['removed'].append(stage)
+        for other in set(others) - seen - found:
+            self.__drop(other)
+        return res
+
+    def runs(self, path=None):
+        '''
+        :param path:
+            Only runs of this stage
+        :returns:
+            A list of dictionaries for each run, with it's 'path', 'run',
+            'first' and 'last' time, count of 'entries' and 'failures'
+            and the 'duration' in seconds, ordered by time
+        '''
+
+        sql = 'SELECT path, run, first, last, entries, failures FROM runs'
+        args = tuple()
+        if path:
+            sql += ' WHERE path = ?'
+            args = (path,)
+        return [dict(
+            path=r[0], run=r[1], first=r[2], last=r[3], entries=r[4],
+            failures=r[5], duration=(r[3] - r[2]) if r[2] and r[3] else None
+        ) for r in self.__fetch(sql + ' ORDER BY first', args)]
+
+    def query(self, command=None, message=None, failed=None,
+              since=None, until=None, path=None, limit=None, newest=True):
+        '''
+        Searches the indexed entries
+
+        :param command:
+            Only entries whose command contains this string
+        :param message:
+            Only entries whose message matches this regular expression
+        :param failed:
+            Only failed (``True``) or not failed (``False``) entries
+        :param since:
+            Only entries from `since` on (|param_since_until|)
+        :param until:
+            Only entries up to `until` (|param_since_until|)
+        :param path:
+            Only entries of this stage
+        :param limit:
+            Return not more than `limit` entries
+        :param newest:
+            Newest entries first (otherwise oldest first)
+        :returns:
+            A list of dictionaries for each entry, with it's 'path',
+            'run', 'key', 'time', 'message', 'command', 'returncode',
+            'failed' state and 'duration'
+        '''
+
+        if isinstance(since, str):
+            since = parse_timestamp(since)
+        if isinstance(until, str):
+            until = parse_timestamp(until)
+
+        where, args = list(), list()
+        for clause, value in [
+            ('command LIKE ?', None if command is None else '%%%s%%' % (
+                command
+            )),
+            ('message REGEXP ?', message),
+            ('failed = ?', None if failed is None else int(bool(failed))),
+            ('time >= ?', since),
+            ('time <= ?', until),
+            ('path = ?', path),
+        ]:
+            if value is not None:
+                where.append(clause)
+                args.append(value)
+
+        sql = '''SELECT path, run, key, time, message, command,
+            returncode, failed, duration FROM entries'''
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY time %s' % ('DESC' if newest else 'ASC')
+        if limit:
+            sql += ' LIMIT %d' % (int(limit))
+        return [dict(
+            path=r[0], run=r[1], key=r[2], time=r[3], message=r[4],
+            command=r[5], returncode=r[6], failed=bool(r[7]), duration=r[8]
+        ) for r in self.__fetch(sql, tuple(args))]
+
+    def last_failure(self, command):
+        '''
+        :param command:
+            The command (or a part of it) to look for
+        :returns:
+            The last failed entry running `command` (see :meth:`query`)
+            or ``None``
+        '''
+
+        r = self.query(command=command, failed=True, limit=1)
+        return r[0] if r else None
+
+    def close(self):
+        '''
+        Closes the index
+        '''
+
+        self.__lock.acquire()
+        try:
+            self.__db.close()
+        finally:
+            self.__lock.release()
+
+    def __index(self, stage, fingerprint):
+        header = read_header(stage)
+        default_run = header.get('ident') if isinstance(header, dict) else None
+
+        runs, rows = dict(), list()
+        for key, elem in iter_log(stage, resolve=True):
+            e = elem if isinstance(elem, dict) else dict()
+            more = e.get('more') if isinstance(e.get('more'), dict) else dict()
+            run = key.rsplit('-', 1)[0] if 'seq' in e else default_run
+            t = entry_time(key, elem)
+            returncode = more.get('returncode')
+            failed = int(_failed(elem))
+            command = more.get('command')
+            rows.append((
+                stage, run, key, t,
+                None if e.get('message') is None else str(e['message']),
+                None if command is None else str(command),
+                returncode if isinstance(returncode, int) else None,
+                failed,
+                more.get('duration')
+            ))
+            r = runs.setdefault(run, [t, t, 0, 0])
+            if t is not None:
+                r[0] = t if r[0] is None else min(r[0], t)
+                r[1] = t if r[1] is None else max(r[1], t)
+            r[2] += 1
+            r[3] += failed
+
+        self.__lock.acquire()
+        try:
+            with self.__db:
+                for table in ['others', 'runs', 'entries']:
+                    self.__db.execute(
+                        'DELETE FROM %s WHERE path = ?' % (table), (stage,)
+                    )
+                self.__db.executemany(
+                    'INSERT OR REPLACE INTO entries VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?)', rows
+                )
+                self.__db.executemany(
+                    'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                    [(stage, run) + tuple(r) for run, r in runs.items()]
+                )
+                self.__db.execute(
+                    'INSERT OR REPLACE INTO files VALUES (?, ?)',
+                    (stage, fingerprint)
+                )
+        finally:
+            self.__lock.release()
+
+    def __other(self, filename, fingerprint):
+        self.__drop(filename)
+        self.__lock.acquire()
+        try:
+            with self.__db:
+                self.__db.execute(
+                    'INSERT OR REPLACE INTO others VALUES (?, ?)',
+                    (filename, fingerprint)
+                )
+        finally:
+            self.__lock.release()
+
+    def __drop(self, stage):
+        self.__lock.acquire()
+        try:
+            with self.__db:
+                for table in ['files', 'others', 'runs', 'entries']:
+                    self.__db.execute(
+                        'DELETE FROM %s WHERE path = ?' % (table), (stage,)
+                    )
+        finally:
+            self.__lock.release()
+
+    def __fetch(self, sql, args=tuple()):
+        self.__lock.acquire()
+        try:
+            return self.__db.execute(sql, args).fetchall()
+        finally:
+            self.__lock.release()
@@ -61,6 +61,12 @@ class Photon(object):
         Pass `config` down to :class:`settings.Settings`
     :param meta:
         Pass `meta` down to :class:`meta.Meta`
+    :param dict meta_options:
+        Pass further keyword arguments down to :class:`meta.Meta`
+        (e.g. ``dict(journal=True)``)
+    :param dict settings_options:
+        Pass further keyword arguments down to :class:`settings.Settings`
+        (e.g. ``dict(layers=['config_{hostname}.yaml'])``)
     :param verbose:
         Sets the global `verbose` flag. Passes it down to the underlying
         :ref:`util` functions and :ref:`core`
@@ -73,11 +79,19 @@ class Photon(object):
     '''
 
     def __init__(self, defaults,
-                 config='config.yaml', meta='meta.json', verbose=True):
+                 config='config.yaml', meta='meta.json', verbose=True,
+                 meta_options=None, settings_options=None):
         super().__init__()
 
-        self.settings = Settings(defaults, config=config, verbose=verbose)
-        self.meta = Meta(meta=meta, verbose=verbose)
+        if not meta_options:
+            meta_options = dict()
+        if not settings_options:
+            settings_options = dict()
+
+        self.settings = Settings(
+            defaults, config=config, verbose=verbose, **settings_options
+        )
+        self.meta = Meta(meta=meta, verbose=verbose, **meta_options)
         self.__verbose = verbose
 
         self.s2m
@@ -1,13 +1,161 @@
 '''
-.. |yaml_loaders| replace:: :func:`util.structures.yaml_str_join`
-    and :func:`util.structures.yaml_loc_join`
+.. |yaml_loaders| replace:: :func:`util.structures.yaml_str_join`,
+    :func:`util.structures.yaml_loc_join`
+    and :func:`util.structures.yaml_include`
 '''
 
-from photon.util.files import read_yaml, write_yaml
+from copy import deepcopy as _deepcopy
+from hashlib import sha1 as _sha1
+from json import dumps as _dumps
+from json import loads as _loads
+from os import environ as _environ
+from os import path as _path
+from os import stat as _stat
+from socket import gethostname as _gethostname
+from threading import Event, Lock, Thread
+
+from yaml import YAMLError, safe_load
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
+from photon import IDENT
+from photon.util.files import compose_yaml, file_fingerprint, read_file, \
+    read_json, read_yaml, write_json, write_yaml
+from photon.settingssnapshot import write_snapshot
 from photon.util.locations import get_locations, search_location
-from photon.util.structures import dict_merge, yaml_loc_join, yaml_str_join
+from photon.util.structures import DYNAMIC, KeyIndex, LazyDict, \
+    dict_diff, dict_provenance, dict_stack, included_files, yaml_include, \
+    yaml_loc_join, yaml_str_join
 from photon.util.system import shell_notify
 
+_MISSING = object()
+
+RUNTIME = ['locations', 'files']
+'''
+Keys put into the settings at runtime.
+They are not considered by the ``'diff'`` `writeback`
+'''
+
+WRITEBACK = ['full', 'diff']
+'''
+Modes to write back the `config` (see :class:`Settings`)
+'''
+
+CACHE = 'photon_settings_%s.json'
+'''
+Filename of the compiled settings cache within 'data_dir'
+from :func:`util.locations.get_locations`.
+The placeholder is filled with a digest of the `defaults` and `config` paths
+'''
+
+SNAPSHOT = 'photon_settings_%s.snapshot'
+'''
+Filename of the snapshots written by :meth:`Settings.publish`
+within 'data_dir' from :func:`util.locations.get_locations`.
+The placeholder is filled like in :data:`CACHE`
+'''
+
+ENVIRON = 'PHOTON'
+'''
+Suggested prefix of environment variables overriding settings
+(pass it as `environ` to :class:`Settings`)
+'''
+
+
+class SettingsLoader(SafeLoader):
+    '''
+    The YAML loader of :class:`Settings`.
+
+    Based on the safe loader of libyaml (if available), with
+    ``!str_join``, ``!loc_join`` and ``!include``
+    registered once (see |yaml_loaders|)
+    '''
+
+
+SettingsLoader.add_constructor('!str_join', yaml_str_join)
+SettingsLoader.add_constructor('!loc_join', yaml_loc_join)
+SettingsLoader.add_constructor('!include', yaml_include)
+
+
+def _user_visible(settings):
+    return dict(
+        (key, val) for key, val in settings.items() if key not in RUNTIME
+    )
+
+
+def _apply(target, source, path):
+    for key in path[:-1]:
+        target, source = target[key], source[key]
+    if path[-1] in source:
+        target[path[-1]] = _deepcopy(source[path[-1]])
+    else:
+        target.pop(path[-1], None)
+
+
+def _scalar(value):
+    try:
+        return safe_load(value)
+    except YAMLError:
+        return value
+
+
+def _nested(res, path, value):
+    target = res
+    for key in path[:-1]:
+        if not isinstance(target.get(key), dict):
+            target[key] = dict()
+        target = target[key]
+    target[path[-1]] = value
+    return res
+
+
+def _environ_layer(prefix):
+    res = dict()
+    for name in sorted(_environ):
+        if name.startswith(prefix + '__'):
+            path = name[len(prefix) + 2:].split('__')
+            if all(path):
+                _nested(res, path, _scalar(_environ[name]))
+    return res
+
+
+def _overrides_layer(overrides):
+    if isinstance(overrides, dict):
+        return overrides
+    res = dict()
+    for override in overrides:
+        dotted, _, value = override.partition('=')
+        path = dotted.strip().split('.')
+        if all(path):
+            _nested(res, path, _scalar(value))
+    return res
+
+
+def _stamp(filename):
+    if filename and _path.isfile(filename):
+        s = _stat(filename)
+        return s.st_mtime_ns, s.st_size
+
+
+class SettingsDumper(SafeDumper):
+    '''
+    The YAML dumper of :class:`Settings`.
+
+    Based on the safe dumper of libyaml (if available).
+    Writes repeated values out in full instead of using anchors,
+    so the `config` stays easy to edit
+    '''
+
+    def ignore_aliases(self, data):
+        return True
+
+
+SettingsDumper.add_representer(LazyDict, SettingsDumper.represent_dict)
+
 
 class Settings(object):
     '''
@@ -29,7 +177,12 @@ class Settings(object):
         * Insert keywords like **home_dir** or \
         **conf_dir** using ``!loc_join``
 
+        * Include shared YAML-files using ``!include``. \
+        Each of them is parsed only once, even if included many times
+
     It is also possible to import or merge further content.
+    Changes of the loaded files are picked up by :meth:`reload`
+    (or in the background by :meth:`watch`).
 
     :param defaults: The initial configuration to load. |filelocate|
 
@@ -77,23 +230,96 @@ class Settings(object):
     :param verbose: Sets the `verbose` flag for \
     the underlying :ref:`util` functions
 
+    :param durability: Pass `durability` down to \
+    :func:`util.files.write_file` when writing back the `config`. \
+    Defaults to ``'fsync-file'``, a broken config is worse than a slow one
+
+    :param cache: Keep the compiled settings in a cache file \
+    (see :data:`CACHE`). Off by default
+
+        * The next launch takes the settings from there, without \
+        parsing any YAML, if `defaults`, `config`, the `layers` and \
+        files included by them are unchanged \
+        (by path, size, modification time and content hash) \
+        and the locations and hostname are still the same
+
+        * Not used in `lazy` mode, if `defaults` are passed as dict, \
+        if they or the `config` contain keywords from \
+        :data:`util.structures.DYNAMIC`, \
+        or if the settings can't be represented as json
+
+    :param lazy: Only compose the YAML-files at first. \
+    Values (including ``!str_join`` and ``!loc_join``) are constructed \
+    and merged when accessed through :attr:`get` (see \
+    :class:`util.structures.LazyDict`), so unused parts cost nothing.
+
+        * Writing back the `config` still resolves everything, \
+        so use it together with ``config=None`` for the full effect
+
+    :param writeback: How to write back the `config` (see :data:`WRITEBACK`)
+
+        * ``'full'`` (the default): Dump all of the settings into it, \
+        whenever they differ from it's content
+
+        * ``'diff'``: Only write if a key path outside of :data:`RUNTIME` \
+        differs, and only change these paths in the content of the `config`
+
+    :param layers: Further YAML-files merged on top of the `config`, \
+    in this order (e.g. per-host overrides). |filelocate|
+
+        * ``{hostname}`` within a filename is replaced by the \
+        short hostname (like ``'config_{hostname}.yaml'``)
+
+        * Missing files are skipped, they are never written back
+
+    :param environ: Prefix of environment variables to merge on top \
+    of the `layers` (like :data:`ENVIRON`). \
+    Left to ``None``, the environment is not read
+
+        * ``PHOTON__mail__sender=root@example.org`` sets \
+        ``mail: {sender: ...}``, the keys are separated by ``__``
+
+        * The values are parsed as YAML, so numbers and booleans work
+
+    :param overrides: Merged on top of everything else \
+    (e.g. from the command line). \
+    Either a dictionary, or a list of strings like ``'mail.sender=root'`` \
+    (dotted key path, value parsed as YAML)
+
+    All of them are merged in one pass (see \
+    :func:`util.structures.dict_stack`), only the parts they change \
+    are copied. Where each value comes from is told by :meth:`provenance`.
+    The `environ` and `overrides` are never written back nor cached
+
     .. seealso:: |yaml_loaders| as well as the :ref:`settings_file_example`
     '''
 
-    def __init__(self, defaults, config='config.yaml', verbose=True):
+    def __init__(self, defaults, config='config.yaml', verbose=True,
+                 durability='fsync-file', cache=False, lazy=False,
+                 writeback='full', layers=None, environ=None,
+                 overrides=None):
 
         super().__init__()
 
         self.__verbose = verbose
-        self.__settings = {
+        self.__durability = durability
+        self.__lazy = lazy
+        self.__writeback = writeback if writeback in WRITEBACK else 'full'
+        self.__layers = list()
+        self.__subscribers = list()
+        self.__lock = Lock()
+        self.__watcher = None
+        self.__includes = dict()
+        self.__index = None
+        self.__settings, self.__provenance = dict_stack([('runtime', {
             'locations': get_locations(),
             'files': dict()
-        }
-
-        loaders = [
-            ('!str_join', yaml_str_join,),
-            ('!loc_join', yaml_loc_join,)
-        ]
+        })])
+        self.__base = dict(
+            locations=dict(self.__settings['locations']), files=dict()
+        )
+        if lazy:
+            self.__settings = LazyDict([(None, self.__settings)])
 
         defaults, sdict = (
             'startup import',
@@ -103,11 +329,37 @@ class Settings(object):
             None
         )
 
+        if config:
+            config = search_location(config, create_in='conf_dir')
+
+        hostname = _gethostname().split('.')[0]
+        layers = [(name, search_location(name)) for name in [
+            layer.format(hostname=hostname) for layer in layers or list()
+        ]]
+        sources = [defaults, config] + [sdesc for _, sdesc in layers]
+
+        self.__digest = _sha1(('%s\0%s' % (
+            defaults, config
+        )).encode('utf-8')).hexdigest()[:16]
+
+        cache = search_location(
+            CACHE % (self.__digest), create_in='data_dir'
+        ) if (
+            cache and not sdict and not lazy
+        ) else None
+        if cache and self.__cache_read(cache, sources):
+            for skey, sdesc in [
+                ('defaults', defaults), ('config', config)
+            ] + layers:
+                if sdesc:
+                    self.__layer(skey, sdesc, None, None, True)
+            self.__override(environ, overrides)
+            return
+
         if not self.load(
             'defaults',
             defaults,
             sdict=sdict,
-            loaders=loaders,
             merge=True
         ):
             shell_notify(
@@ -117,19 +369,22 @@ class Settings(object):
             )
 
         if config:
-            config = search_location(config, create_in='conf_dir')
-            if self.__settings != self.load(
+            self.load(
                 'config',
                 config,
-                loaders=loaders,
                 merge=True,
                 writeback=True
-            ):
-                shell_notify(
-                    'settings config written',
-                    more=config,
-                    verbose=verbose
-                )
+            )
+
+        for skey, sdesc in layers:
+            if sdesc:
+                self.load(skey, sdesc, merge=True)
+        self.__includes = dict((f, _stamp(f)) for f in included_files())
+
+        if cache:
+            self.__cache_write(cache, sources)
+
+        self.__override(environ, overrides)
 
     def load(self, skey, sdesc,
              sdict=None, loaders=None, merge=False, writeback=False):
@@ -147,28 +402,42 @@ class Settings(object):
             it from a yaml-file. \
             Make sure to set `skey` and `sdesc` accordingly
         :param list loaders:
-            Append custom loaders to the YAML-loader.
+            Append custom loaders to the YAML-loader
+            (only for this call, see :class:`SettingsLoader`)
         :param merge:
             Merge received data into current settings or \
             place it under `skey` within meta
         :param writeback:
             Write back loaded (and merged/imported) result back \
             to the original file. \
-            This is used to generate the summary files
+            This is used to generate the summary files. \
+            Pass ``True`` to use the mode :class:`Settings` was started \
+            with, or one of :data:`WRITEBACK`
         :returns:
             The loaded (or directly passed) content
 
         .. seealso:: |yaml_loaders|
         '''
 
-        y = sdict if sdict else read_yaml(sdesc, add_constructor=loaders)
+        y = sdict if sdict else (
+            compose_yaml if self.__lazy else read_yaml
+        )(sdesc, add_constructor=loaders, loader=SettingsLoader)
         if y and isinstance(y, dict):
+            self.__index = None
             if not sdict:
                 self.__settings['files'].update({skey: sdesc})
-            if merge:
-                self.__settings = dict_merge(self.__settings, y)
-            else:
+                self.__base['files'].update({skey: sdesc})
+            if merge and self.__lazy:
+                self.__settings.merge(y)
+            elif self.__lazy:
                 self.__settings[skey] = y
+            else:
+                if not merge:
+                    self.__settings.pop(skey, None)
+                self.__settings, _ = dict_stack(
+                    [(skey, y if merge else {skey: y})],
+                    base=self.__settings, provenance=self.__provenance
+                )
             shell_notify(
                 'load %s data and %s it into settings' % (
                     'got' if sdict else 'read',
@@ -178,10 +447,230 @@ class Settings(object):
                           merge=merge, writeback=writeback),
                 verbose=self.__verbose
             )
-        if writeback and y != self.__settings:
-            write_yaml(sdesc, self.__settings)
+        content = y if y and isinstance(y, dict) else dict()
+        if writeback:
+            written = self.__write_back(
+                sdesc, content,
+                self.__writeback if writeback is True else writeback
+            )
+            if written is not None:
+                content = written
+        self.__layer(skey, None if sdict else sdesc, loaders, content, merge)
         return y
 
+    def reload(self):
+        '''
+        Reloads the settings, if any of the loaded files
+        (or files included by them) changed
+        (by modification time and size) since.
+
+        * Only the changed files are read again, \
+        and only the affected parts of the settings are merged again. \
+        :attr:`get` is updated in place
+
+        * Nothing is written back, and the cache is left alone
+
+        :returns:
+            A list of key paths (see :func:`util.structures.dict_diff`)
+            which changed. The subscribers (see :meth:`subscribe`)
+            are called with it, if it is not empty
+        '''
+
+        self.__lock.acquire()
+        try:
+            keys = set()
+            includes = dict((f, _stamp(f)) for f in set(
+                self.__includes
+            ) | set(included_files()))
+            touched = includes != self.__includes
+            self.__includes = includes
+            for layer in self.__layers:
+                stamp = _stamp(layer['sdesc'])
+                if not layer['sdesc'] or (
+                    stamp == layer['stamp'] and not touched
+                ):
+                    continue
+                layer['stamp'] = stamp
+                try:
+                    y = read_yaml(
+                        layer['sdesc'], add_constructor=layer['loaders'],
+                        loader=SettingsLoader
+                    )
+                except YAMLError as ex:
+                    shell_notify(
+                        'could not reload settings',
+                        more=dict(sdesc=layer['sdesc'], error=str(ex)),
+                        verbose=self.__verbose
+                    )
+                    continue
+                y = y if y and isinstance(y, dict) else dict()
+                old, layer['content'] = layer['content'], y
+                if not layer['merge']:
+                    keys.add(layer['skey'])
+                elif old is None:
+                    keys.update(self.__settings.keys())
+                    for other in self.__layers:
+                        if other['merge'] and other['content'] is None:
+                            other['content'] = read_yaml(
+                                other['sdesc'],
+                                add_constructor=other['loaders'],
+                                loader=SettingsLoader
+                            ) or dict()
+                        keys.update((other['content'] or dict()).keys())
+                else:
+                    keys.update(p[0] for p in dict_diff(old, y))
+
+            old, new = dict(), dict()
+            for key in keys:
+                if key in self.__settings:
+                    old[key] = self.__settings[key]
+                value, provenance = self.__merged(key)
+                for path in [p for p in self.__provenance if p[0] == key]:
+                    del self.__provenance[path]
+                self.__provenance.update(provenance)
+                if value is _MISSING:
+                    if key in self.__settings:
+                        del self.__settings[key]
+                else:
+                    new[key] = self.__settings[key] = value
+            paths = dict_diff(old, new)
+            if paths:
+                self.__index = None
+            subscribers = list(self.__subscribers)
+        finally:
+            self.__lock.release()
+
+        if paths:
+            shell_notify(
+                'settings reloaded',
+                more=dict(changed=['.'.join(
+                    str(k) for k in p
+                ) for p in paths]),
+                verbose=self.__verbose
+            )
+            for callback in subscribers:
+                callback(paths)
+        return paths
+
+    def subscribe(self, callback):
+        '''
+        Subscribe to changes found by :meth:`reload`
+
+        :param callback:
+            Gets called with the list of changed key paths
+        '''
+
+        self.__lock.acquire()
+        try:
+            if callback not in self.__subscribers:
+                self.__subscribers.append(callback)
+        finally:
+            self.__lock.release()
+
+    def unsubscribe(self, callback):
+        '''
+        :param callback:
+            Stop calling `callback` (see :meth:`subscribe`)
+        '''
+
+        self.__lock.acquire()
+        try:
+            if callback in self.__subscribers:
+                self.__subscribers.remove(callback)
+        finally:
+            self.__lock.release()
+
+    def watch(self, interval=5):
+        '''
+        Starts a background thread, which calls :meth:`reload`
+        every `interval` seconds
+
+        :param interval:
+            Seconds between each check for changes
+        '''
+
+        self.unwatch()
+        stop = Event()
+
+        def loop():
+            while not stop.wait(interval):
+                self.reload()
+
+        self.__watcher = (Thread(
+            target=loop, name='%s settings watcher' % (IDENT)
+        ), stop)
+        self.__watcher[0].daemon = True
+        self.__watcher[0].start()
+
+    def unwatch(self):
+        '''
+        Stops the background thread started by :meth:`watch`
+        '''
+
+        if self.__watcher:
+            thread, stop = self.__watcher
+            self.__watcher = None
+            stop.set()
+            thread.join()
+
+    def __write_back(self, sdesc, content, mode):
+        if mode == 'diff':
+            paths = dict_diff(
+                _user_visible(content), _user_visible(self.__settings)
+            )
+            if not paths:
+                return
+            res = _deepcopy(content)
+            for path in paths:
+                _apply(res, self.__settings, path)
+        elif content != self.__settings:
+            res = _deepcopy(self.__settings)
+        else:
+            return
+
+        write_yaml(
+            sdesc, res, durability=self.__durability, dumper=SettingsDumper
+        )
+        shell_notify(
+            'settings config written',
+            more=dict(config=sdesc, mode=mode),
+            verbose=self.__verbose
+        )
+        return res
+
+    def __layer(self, skey, sdesc, loaders, content, merge):
+        self.__lock.acquire()
+        try:
+            self.__layers.append(dict(
+                skey=skey, sdesc=sdesc, loaders=loaders, content=content,
+                merge=merge, stamp=_stamp(sdesc)
+            ))
+        finally:
+            self.__lock.release()
+
+    def __merged(self, key):
+        stack = list()
+        if key in self.__base:
+            stack.append(('runtime', {key: self.__base[key]}))
+        for layer in self.__layers:
+            content = layer['content'] or dict()
+            if layer['merge'] and key in content:
+                stack.append((layer['skey'], {key: content[key]}))
+            elif not layer['merge'] and layer['skey'] == key:
+                stack = [(layer['skey'], {key: content})]
+        res, provenance = dict_stack(stack)
+        return res.get(key, _MISSING), provenance
+
+    def __override(self, environ, overrides):
+        for skey, content in [
+            ('environ', _environ_layer(environ) if environ else None),
+            ('overrides', _overrides_layer(overrides) if overrides else None)
+        ]:
+            if content:
+                self.load(
+                    skey, 'startup %s' % (skey), sdict=content, merge=True
+                )
+
     @property
     def get(self):
         '''
@@ -189,3 +678,133 @@ class Settings(object):
         '''
 
         return self.__settings
+
+    def publish(self, filename=None):
+        '''
+        Publishes the current settings as an immutable snapshot,
+        for other processes to attach to (without parsing any YAML)
+        using :class:`settingssnapshot.SettingsSnapshot`
+
+        :param filename:
+            Where to write the snapshot.
+            Uses :data:`SNAPSHOT` if left to ``None``
+        :returns:
+            The full path of the snapshot
+
+        * Publishing again replaces the snapshot, \
+        attached processes keep the old one until they attach again
+
+        * In `lazy` mode, publishing resolves everything
+        '''
+
+        if not filename:
+            filename = search_location(
+                SNAPSHOT % (self.__digest), create_in='data_dir'
+            )
+        self.__lock.acquire()
+        try:
+            write_snapshot(filename, self.__settings, self.__provenance)
+        finally:
+            self.__lock.release()
+        shell_notify(
+            'settings published',
+            more=dict(snapshot=filename),
+            verbose=self.__verbose
+        )
+        return filename
+
+    def provenance(self, path):
+        '''
+        :param path:
+            A key path, list of keys or a dotted string
+            (see :meth:`util.structures.KeyIndex.path`)
+        :returns:
+            Where the value at `path` comes from: ``'runtime'``,
+            ``'defaults'``, ``'config'``, the name of one of the `layers`,
+            ``'environ'``, ``'overrides'`` (or the `skey` passed to
+            :meth:`load`). ``None`` if `path` does not exist,
+            or in `lazy` mode
+        '''
+
+        if not self.__lazy:
+            path = self.index.path(path)
+            if path is not None:
+                return dict_provenance(self.__provenance, path)
+
+    @property
+    def index(self):
+        '''
+        :returns:
+            A :class:`util.structures.KeyIndex` of the current settings,
+            for lookups of dotted paths (like ``settings.index['a.b.c']``),
+            enumeration of paths and reverse lookups.
+
+            * It is built on first access after each :meth:`load` \
+            or :meth:`reload`. Changes to :attr:`get` in between \
+            are not reflected
+
+            * In `lazy` mode, building it resolves everything
+        '''
+
+        index = self.__index
+        if index is None:
+            index = self.__index = KeyIndex(self.__settings)
+        return index
+
+    def __cache_key(self, sources):
+        return dict(
+            sources=[file_fingerprint(s) for s in sources],
+            locations=self.__settings['locations'],
+            hostname=_gethostname().split('.')[0]
+        )
+
+    def __cache_read(self, cache, sources):
+        try:
+            c = read_json(cache)
+        except ValueError:
+            return False
+        if not c or not isinstance(c, dict) or (
+            c.get('key') != self.__cache_key(
+                sources + (c.get('includes') or list())
+            )
+        ):
+            return False
+        self.__settings = c['settings']
+        self.__base['files'] = dict(self.__settings['files'])
+        self.__includes = dict(
+            (f, _stamp(f)) for f in c.get('includes') or list()
+        )
+        entries = c.get('provenance') or list()
+        self.__provenance = dict(
+            (tuple(path), (n - len(entries), name))
+            for n, (path, name) in enumerate(entries)
+        )
+        shell_notify(
+            'load settings from cache',
+            more=dict(cache=cache, files=self.__settings.get('files')),
+            verbose=self.__verbose
+        )
+        return True
+
+    def __cache_write(self, cache, sources):
+        includes = included_files()
+        sources = sources + includes
+        for s in sources:
+            content = read_file(s) if s else None
+            if content and '!str_join' in content and any(
+                d in content for d in DYNAMIC
+            ):
+                return
+        try:
+            if _loads(_dumps(self.__settings)) != self.__settings:
+                return
+        except (TypeError, ValueError):
+            return
+        write_json(cache, dict(
+            key=self.__cache_key(sources),
+            includes=includes,
+            settings=self.__settings,
+            provenance=[[list(path), name] for path, (_, name) in sorted(
+                self.__provenance.items(), key=lambda p: p[1][0]
+            )]
+        ))
@@ -0,0 +1,271 @@
+'''
+.. |snapshot_layout| replace::
+    Each dictionary is stored as a table of it's keys (sorted,
+    to be searched by bisection) pointing to the values.
+    All other values are stored :py:mod:`marshal`-ed
+    (or :py:mod:`pickle`-d, if marshal can't, e.g. for dates)
+'''
+
+from collections.abc import Mapping
+from marshal import dumps as _dumps
+from marshal import loads as _loads
+from mmap import ACCESS_READ as _ACCESS_READ
+from mmap import mmap as _mmap
+from os import fstat as _fstat
+from os import path as _path
+from os import stat as _stat
+from pickle import HIGHEST_PROTOCOL as _HIGHEST_PROTOCOL
+from pickle import dumps as _pdumps
+from pickle import loads as _ploads
+from struct import Struct as _Struct
+from sys import version_info as _version_info
+
+from photon.util.files import write_file
+from photon.util.structures import KeyIndex, dict_provenance
+
+MAGIC = b'PHOTSNAP'
+'''
+The first bytes of each snapshot file
+'''
+
+_HEADER = _Struct('<8sBBxxQQ')
+_NODE = _Struct('<cI')
+_ENTRY = _Struct('<QIQ')
+_MARSHAL = 2
+
+
+def _pack(buf, value):
+    if isinstance(value, Mapping):
+        entries = sorted(
+            (_key(key), _pack(buf, val)) for key, val in value.items()
+        )
+        keys = list()
+        for key, _ in entries:
+            keys.append(len(buf))
+            buf += key
+        offset = len(buf)
+        buf += _NODE.pack(b'M', len(entries))
+        for (key, voff), koff in zip(entries, keys):
+            buf += _ENTRY.pack(koff, len(key), voff)
+        return offset
+    try:
+        kind, data = b'V', _dumps(value, _MARSHAL)
+    except ValueError:
+        kind, data = b'P', _pdumps(value, _HIGHEST_PROTOCOL)
+    offset = len(buf)
+    buf += _NODE.pack(kind, len(data))
+    buf += data
+    return offset
+
+
+def _unpack(buf, offset):
+    kind, size = _NODE.unpack_from(buf, offset)
+    if kind == b'M':
+        return SnapshotMap(buf, offset)
+    start = offset + _NODE.size
+    return (_ploads if kind == b'P' else _loads)(buf[start:start + size])
+
+
+def _key(key):
+    try:
+        return _dumps(key, _MARSHAL)
+    except ValueError:
+        raise ValueError(
+            'settings key %r can not be stored in a snapshot' % (key,)
+        )
+
+
+def write_snapshot(filename, settings, provenance=None):
+    '''
+    Writes snapshot files (atomically, see :func:`util.files.write_file`)
+
+    :param filename:
+        The full path of the snapshot file
+    :param settings:
+        The settings to store (|snapshot_layout|)
+    :param provenance:
+        The provenance of the settings
+        (see :func:`util.structures.dict_stack`)
+    :returns:
+        The size written
+
+    Raises ``ValueError`` if a key of `settings` is no plain value
+    (like a string or number).
+
+    .. note:: Snapshots are meant to be read by the same python version,
+        which is checked by :class:`SettingsSnapshot`
+    '''
+
+    buf = bytearray(_HEADER.size)
+    root = _pack(buf, settings)
+    prov = _pack(buf, provenance) if provenance else 0
+    _HEADER.pack_into(
+        buf, 0, MAGIC, _version_info[0], _version_info[1], root, prov
+    )
+    return write_file(filename, bytes(buf))
+
+
+class SnapshotMap(Mapping):
+    '''
+    A read-only dictionary within a snapshot.
+
+    Keys are looked up in place, values are only read when accessed.
+    Nested dictionaries are returned as :class:`SnapshotMap` as well.
+    Like with plain dictionaries, equal numbers of different types
+    (like ``1``, ``1.0`` and ``True``) are the same key
+
+    :param buf:
+        The content of the snapshot file
+    :param offset:
+        Where the dictionary starts within `buf`
+    '''
+
+    def __init__(self, buf, offset):
+        super().__init__()
+
+        self.__buf = buf
+        self.__len = _NODE.unpack_from(buf, offset)[1]
+        self.__table = offset + _NODE.size
+
+    def __entry(self, n):
+        return _ENTRY.unpack_from(self.__buf, self.__table + n * _ENTRY.size)
+
+    def __key(self, n):
+        koff, klen, _ = self.__entry(n)
+        return self.__buf[koff:koff + klen]
+
+    def __find(self, key):
+        try:
+            k = _dumps(key, _MARSHAL)
+        except ValueError:
+            return
+        lo, hi = 0, self.__len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__key(mid) < k:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.__len and self.__key(lo) == k:
+            return self.__entry(lo)[2]
+
+    def __getitem__(self, key):
+        offset = self.__find(key)
+        if offset is None and isinstance(key, (int, float, complex)):
+            for t in [bool, int, float, complex]:
+                try:
+                    k = t(key.real if isinstance(key, complex) else key)
+                except (OverflowError, TypeError, ValueError):
+                    continue
+                if type(k) is not type(key) and k == key:
+                    offset = self.__find(k)
+                    if offset is not None:
+                        break
+        if offset is None:
+            raise KeyError(key)
+        return _unpack(self.__buf, offset)
+
+    def __iter__(self):
+        for n in range(self.__len):
+            yield _loads(self.__key(n))
+
+    def __len__(self):
+        return self.__len
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+
+
+class SettingsSnapshot(object):
+    '''
+    SettingsSnapshot provides read-only access to settings
+    published by :meth:`settings.Settings.publish`.
+
+    The snapshot file is mapped into memory (:py:mod:`mmap`), so all
+    processes attached to it share the same pages,
+    and nothing is parsed or copied up front (|snapshot_layout|).
+    It offers :attr:`get`, :attr:`index` and :meth:`provenance`
+    like :class:`settings.Settings`.
+
+    :param filename:
+        The full path of the snapshot file
+
+    A published snapshot is never changed. Publishing again replaces the
+    file, attached processes keep their version until they attach again
+    (see :attr:`stale`).
+    Raises ``ValueError`` if `filename` is no snapshot
+    (or written by another python version)
+    '''
+
+    def __init__(self, filename):
+        super().__init__()
+
+        with open(filename, 'rb') as f:
+            s = _fstat(f.fileno())
+            self.__map = _mmap(f.fileno(), 0, access=_ACCESS_READ)
+        self.__filename = filename
+        self.__ident = (s.st_dev, s.st_ino)
+        self.__index = None
+
+        if len(self.__map) < _HEADER.size or _HEADER.unpack_from(
+            self.__map
+        )[:3] != (MAGIC,) + tuple(_version_info[:2]):
+            self.__map.close()
+            raise ValueError('no settings snapshot: %s' % (filename))
+        root, prov = _HEADER.unpack_from(self.__map)[3:]
+        self.__settings = _unpack(self.__map, root)
+        self.__provenance = _unpack(self.__map, prov) if prov else dict()
+
+    @property
+    def get(self):
+        '''
+        :returns: The settings (as :class:`SnapshotMap`)
+        '''
+
+        return self.__settings
+
+    @property
+    def index(self):
+        '''
+        :returns:
+            A :class:`util.structures.KeyIndex` of the settings.
+            It is built on first access (reading all of the settings)
+        '''
+
+        if self.__index is None:
+            self.__index = KeyIndex(self.__settings)
+        return self.__index
+
+    def provenance(self, path):
+        '''
+        :param path:
+            A key path, list of keys or a dotted string
+        :returns:
+            Where the value at `path` comes from
+            (see :meth:`settings.Settings.provenance`)
+        '''
+
+        path = self.index.path(path)
+        if path is not None:
+            return dict_provenance(self.__provenance, path)
+
+    @property
+    def stale(self):
+        '''
+        :returns:
+            ``True`` if the snapshot file was replaced (or removed)
+            since attaching to it
+        '''
+
+        if not _path.exists(self.__filename):
+            return True
+        s = _stat(self.__filename)
+        return (s.st_dev, s.st_ino) != self.__ident
+
+    def close(self):
+        '''
+        Detaches from the snapshot file.
+        Values read before remain usable, :class:`SnapshotMap` do not
+        '''
+
+        self.__map.close()
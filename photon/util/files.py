@@ -1,8 +1,43 @@
+from contextlib import contextmanager as _contextmanager
+from fcntl import LOCK_EX as _LOCK_EX
+from fcntl import LOCK_UN as _LOCK_UN
+from fcntl import flock as _flock
+from functools import lru_cache as _lru_cache
+from hashlib import sha1 as _sha1
+from json import JSONDecoder as _JSONDecoder
 from json import dumps as _dumps
 from json import loads as _loads
+from os import O_CREAT as _O_CREAT
+from os import O_EXCL as _O_EXCL
+from os import O_RDONLY as _O_RDONLY
+from os import O_WRONLY as _O_WRONLY
+from os import chmod as _chmod
+from os import close as _close
+from os import fdopen as _fdopen
+from os import fsync as _fsync
+from os import getpid as _getpid
+from os import open as _open
 from os import path as _path
+from os import remove as _remove
+from os import replace as _replace
+from os import stat as _stat
+from random import randint as _randint
 
 import yaml as _yaml
+from yaml.nodes import MappingNode as _MappingNode
+
+from photon.util.structures import LazyDict
+
+try:
+    from yaml import CDumper as Dumper
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Dumper, Loader
+
+DURABILITY = ['none', 'fsync-file', 'fsync-file+dir']
+'''
+Durability policies for :func:`write_file`
+'''
 
 
 def read_file(filename):
@@ -26,14 +61,45 @@ def read_file(filename):
             return f.read()
 
 
-def read_yaml(filename, add_constructor=None):
+def file_fingerprint(filename):
+    '''
+    Fingerprints files
+
+    :param filename:
+        The full path of the file
+    :returns:
+        A dictionary with the 'path', 'size', 'mtime_ns' and the
+        'sha1' of the content of `filename` (or ``None`` if it is missing)
+    '''
+
+    if not filename or not _path.isfile(filename):
+        return
+    s = _stat(filename)
+    with open(filename, 'rb') as f:
+        digest = _sha1(f.read()).hexdigest()
+    return dict(
+        path=filename, size=s.st_size, mtime_ns=s.st_mtime_ns, sha1=digest
+    )
+
+
+def read_yaml(filename, add_constructor=None, loader=None):
     '''
     Reads YAML files
 
     :param filename:
         The full path to the YAML file
     :param add_constructor:
-        A list of yaml constructors (loaders)
+        A list of yaml constructors (loaders).
+        They are registered on a subclass of `loader`,
+        so other users of `loader` are not affected.
+        The subclass is reused for the same constructors
+    :param loader:
+        The YAML loader class to use.
+        Uses the full loader of libyaml (if available,
+        the pure-Python one otherwise) if left to ``None``.
+        It constructs python objects from python tags,
+        so pass a safe loader for files which are not trusted
+        (like :class:`settings.Settings` does)
     :returns:
         Loaded YAML content as represented data structure
 
@@ -43,13 +109,55 @@ def read_yaml(filename, add_constructor=None):
     '''
 
     y = read_file(filename)
+    if y:
+        return _yaml.load(y, Loader=_loader(loader, add_constructor))
+
+
+def compose_yaml(filename, add_constructor=None, loader=None):
+    '''
+    Reads YAML files lazily
+
+    Like :func:`read_yaml`, but the content is only composed
+    into YAML nodes at first.
+
+    :returns:
+        A :class:`util.structures.LazyDict` if the content is a mapping
+        (the values are constructed on first access),
+        the loaded content otherwise
+    '''
+
+    y = read_file(filename)
+    if y:
+        lo = _loader(loader, add_constructor)(y)
+        node = lo.get_single_node()
+        if isinstance(node, _MappingNode) and node.tag == (
+            'tag:yaml.org,2002:map'
+        ):
+            return LazyDict([(lo, node)])
+        if node is not None:
+            return lo.construct_document(node)
+
+
+def _loader(loader, add_constructor):
+    if not loader:
+        loader = Loader
     if add_constructor:
         if not isinstance(add_constructor, list):
             add_constructor = [add_constructor]
-        for a in add_constructor:
-            _yaml.add_constructor(*a)
-    if y:
-        return _yaml.load(y)
+        constructors = tuple(tuple(a) for a in add_constructor)
+        try:
+            return _subloader(loader, constructors)
+        except TypeError:
+            return _subloader.__wrapped__(loader, constructors)
+    return loader
+
+
+@_lru_cache(maxsize=32)
+def _subloader(loader, constructors):
+    loader = type(loader.__name__, (loader,), dict())
+    for a in constructors:
+        loader.add_constructor(*a)
+    return loader
 
 
 def read_json(filename):
@@ -67,25 +175,224 @@ def read_json(filename):
         return _loads(j)
 
 
-def write_file(filename, content):
+def iter_json(filename, stream=None, chunk=65536):
+    '''
+    Reads json files incrementally
+
+    The file is read in chunks, only the current member is kept in memory.
+
+    :param filename:
+        The full path to the json file (containing an object)
+    :param stream:
+        The key of a member of the object, which is an object itself.
+        It's members are yielded one by one, instead of all at once
+    :param chunk:
+        Read the file in chunks of this size
+    :returns:
+        A generator yielding pairs of the path (as tuple) and value
+        of each member, e.g. ``(('header',), {...})`` or
+        ``(('log', 'key'), {...})`` (when `stream` is set to 'log')
+    '''
+
+    if not filename or not _path.exists(filename):
+        return
+
+    decoder = _JSONDecoder()
+    with open(filename, 'r') as f:
+        state = dict(buf='', pos=0, eof=False)
+
+        def fill():
+            data = f.read(max(chunk, len(state['buf']) - state['pos']))
+            state['buf'] = state['buf'][state['pos']:] + data
+            state['pos'] = 0
+            state['eof'] = not data
+
+        def skip():
+            while True:
+                buf, pos = state['buf'], state['pos']
+                while pos < len(buf) and buf[pos] in ' \t\n\r':
+                    pos += 1
+                state['pos'] = pos
+                if pos < len(buf) or state['eof']:
+                    return buf[pos] if pos < len(buf) else None
+                fill()
+
+        def expect(chars):
+            c = skip()
+            if c is None or c not in chars:
+                raise ValueError('expected %s at %s' % (chars, filename))
+            state['pos'] += 1
+            return c
+
+        def value():
+            skip()
+            while True:
+                try:
+                    v, end = decoder.raw_decode(state['buf'], state['pos'])
+                    if end < len(state['buf']) or state['eof']:
+                        state['pos'] = end
+                        return v
+                except ValueError:
+                    if state['eof']:
+                        raise
+                fill()
+
+        def members(path):
+            expect('{')
+            if skip() == '}':
+                state['pos'] += 1
+                return
+            while True:
+                key = value()
+                expect(':')
+                if not path and key == stream and skip() == '{':
+                    yield from members((key,))
+                else:
+                    yield path + (key,), value()
+                if expect(',}') == '}':
+                    return
+
+        yield from members(tuple())
+
+
+def iter_json_lines(filename):
+    '''
+    Reads line-oriented json files incrementally
+
+    :param filename:
+        The full path to the file, one json document each line
+    :returns:
+        A generator yielding the loaded json content of each line.
+        Incomplete lines (e.g. after a crash) are skipped
+    '''
+
+    if filename and _path.exists(filename):
+        with open(filename, 'r') as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        yield _loads(line)
+                    except ValueError:
+                        continue
+
+
+@_contextmanager
+def lock_file(filename):
     '''
-    Writes files
+    Holds an exclusive advisory lock (:py:func:`fcntl.flock`)
+    on a file while inside the ``with``-block.
+    Blocks until other processes released their lock.
+
+    :param filename:
+        The full path of the lock file
+        (gets created if necessary, the content is never touched)
+    '''
+
+    with open(filename, 'a') as f:
+        _flock(f, _LOCK_EX)
+        try:
+            yield f
+        finally:
+            _flock(f, _LOCK_UN)
+
+
+def read_json_lines(filename):
+    '''
+    Reads line-oriented json files
+
+    :param filename:
+        The full path to the file, one json document each line
+    :returns:
+        A list with the loaded json content of each line
+
+    .. note:: Incomplete trailing lines (e.g. after a crash) are skipped.
+    '''
+
+    return list(iter_json_lines(filename))
+
+
+def write_file(filename, content, durability='none'):
+    '''
+    Writes files atomically
+
+    The content is written into a temporary file next to `filename`,
+    which then replaces `filename`.
+    So `filename` contains either the old or the new content,
+    but is never left behind half-written.
+    If `filename` is a symbolic link, the file it points to is replaced
+    (the link stays).
 
     :param filename:
         The full path of the file to write
         (enclosing folder must already exist)
     :param content:
-        The content to write
+        The content to write (a string, or bytes for binary files)
+    :param durability:
+        What to do to make sure the content really hits the disk
+        (see :data:`DURABILITY`):
+
+        * ``'none'``: Leave it to the operating system (fastest)
+
+        * ``'fsync-file'``: Sync the file before replacing `filename`
+
+        * ``'fsync-file+dir'``: Also sync the enclosing folder \
+        afterwards, so the replacement itself survives a crash
+
+    :returns:
+        The size of the data written
+
+    Raises ``ValueError`` if `durability` is unknown
+    '''
+
+    if durability not in DURABILITY:
+        raise ValueError('unknown durability: %s' % (durability))
+    if filename:
+        filename = _path.realpath(filename)
+    if filename and _path.exists(_path.dirname(filename)) and content:
+        tmp = '%s.%d-%04x.tmp' % (filename, _getpid(), _randint(0, 0xffff))
+        try:
+            with _fdopen(
+                _open(tmp, _O_WRONLY | _O_CREAT | _O_EXCL, 0o666),
+                'wb' if isinstance(content, bytes) else 'w'
+            ) as f:
+                res = f.write(content)
+                if durability != 'none':
+                    f.flush()
+                    _fsync(f.fileno())
+            if _path.exists(filename):
+                _chmod(tmp, _stat(filename).st_mode)
+            _replace(tmp, filename)
+        finally:
+            if _path.exists(tmp):
+                _remove(tmp)
+        if durability == 'fsync-file+dir':
+            d = _open(_path.dirname(filename), _O_RDONLY)
+            try:
+                _fsync(d)
+            finally:
+                _close(d)
+        return res
+
+
+def append_file(filename, content):
+    '''
+    Appends to files
+
+    :param filename:
+        The full path of the file to append to
+        (enclosing folder must already exist)
+    :param content:
+        The content to append
     :returns:
         The size of the data written
     '''
 
     if filename and _path.exists(_path.dirname(filename)) and content:
-        with open(filename, 'w') as f:
+        with open(filename, 'a') as f:
             return f.write(content)
 
 
-def write_yaml(filename, content):
+def write_yaml(filename, content, durability='none', dumper=None):
     '''
     Writes YAML files
 
@@ -93,16 +400,26 @@ def write_yaml(filename, content):
         The full path to the YAML file
     :param content:
         The content to dump
+    :param durability:
+        Pass `durability` down to :func:`write_file`
+    :param dumper:
+        The YAML dumper class to use.
+        Uses the full dumper of libyaml (if available,
+        the pure-Python one otherwise) if left to ``None``,
+        which writes python tags for objects plain YAML can't represent
     :returns:
         The size written
     '''
 
-    y = _yaml.dump(content, indent=4, default_flow_style=False)
+    y = _yaml.dump(
+        content, Dumper=dumper if dumper else Dumper,
+        indent=4, default_flow_style=False
+    )
     if y:
-        return write_file(filename, y)
+        return write_file(filename, y, durability=durability)
 
 
-def write_json(filename, content):
+def write_json(filename, content, durability='none'):
     '''
     Writes json files
 
@@ -110,10 +427,29 @@ def write_json(filename, content):
         The full path to the json file
     :param content:
         The content to dump
+    :param durability:
+        Pass `durability` down to :func:`write_file`
     :returns:
         The size written
     '''
 
     j = _dumps(content, indent=4, sort_keys=True)
     if j:
-        return write_file(filename, j)
+        return write_file(filename, j, durability=durability)
+
+
+def append_json(filename, content):
+    '''
+    Appends to line-oriented json files
+
+    :param filename:
+        The full path to the file
+    :param content:
+        The content to dump into one single line
+    :returns:
+        The size written
+    '''
+
+    j = _dumps(content, sort_keys=True)
+    if j:
+        return append_file(filename, j + '\n')
@@ -0,0 +1,55 @@
+from json import dumps as _dumps
+from pprint import pformat as _pformat
+
+from yaml import dump as _dump
+
+
+def _p(s):
+    print(s)
+
+
+def _pp(s):
+    return _p(_pformat(s))
+
+
+def _j(s):
+    return _p(_dumps(s, indent=4, sort_keys=True))
+
+
+def _y(s):
+    return _p(_dump(s, indent=4, default_flow_style=False))
+
+
+def _t(s, p=0):
+    if isinstance(s, (str, int, float)):
+        return _p('%s%s' % ('\t'*p, s))
+
+    if isinstance(s, list):
+        return [_t(t, p) for t in s]
+
+    if isinstance(s, dict):
+        for t, u in sorted(s.items()):
+            _t(t, p)
+            _t(u, p+1)
+        return
+
+
+FTYPES = {'j': _j, 'p': _p, 'pp': _pp, 't': _t, 'y': _y}
+'''
+Formatters to choose from in :func:`fmt`:
+p_rint, p_retty_p_rint, j_son, y_aml or nested t_abs
+'''
+
+
+def fmt(structure, ftype):
+    '''
+    Prints structures, shared by the command line scripts
+
+    :param structure:
+        The structure to print
+    :param ftype:
+        A key of :data:`FTYPES`
+    '''
+
+    if ftype in FTYPES.keys():
+        FTYPES[ftype](structure)
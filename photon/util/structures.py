@@ -4,8 +4,97 @@
 .. |yaml_loader_seealso| replace::
     The YAML files mentioned in |allexamples|
 '''
+from collections.abc import Mapping as _Mapping
+from copy import copy as _copy
 from copy import deepcopy as _deepcopy
+from itertools import count as _count
 from os import path as _path
+from socket import gethostname as _gethostname
+from threading import local as _local
+
+from yaml.constructor import ConstructorError as _ConstructorError
+from yaml.nodes import MappingNode as _MappingNode
+from yaml.nodes import SequenceNode as _SequenceNode
+
+KEYWORDS = dict()
+'''
+Keywords of :func:`yaml_str_join` and the functions resolving them.
+Use :func:`register_keyword` to add more
+'''
+
+DYNAMIC = list()
+'''
+Keywords which change on every launch
+(settings using them are never cached, see :class:`settings.Settings`)
+'''
+
+_HOSTNAME = dict()
+
+_PENDING = object()
+
+_MAP_TAG = 'tag:yaml.org,2002:map'
+
+_STACKED = _count()
+
+_INCLUDES = dict()
+
+_INCLUDING = _local()
+
+
+def register_keyword(name, resolver, dynamic=False):
+    '''
+    Registers a keyword for :func:`yaml_str_join`
+
+    :param name:
+        The keyword
+    :param resolver:
+        A function without arguments returning the value.
+        It is called lazily, at most once per loaded YAML-file
+    :param dynamic:
+        Set to ``True`` if the value changes on every launch
+        (see :data:`DYNAMIC`)
+
+    Register further keywords like this::
+
+        register_keyword('fqdn', socket.getfqdn)
+        register_keyword('pid', os.getpid, dynamic=True)
+        register_keyword('user', lambda: os.environ.get('USER'))
+    '''
+
+    KEYWORDS[name] = resolver
+    if dynamic and name not in DYNAMIC:
+        DYNAMIC.append(name)
+    elif not dynamic and name in DYNAMIC:
+        DYNAMIC.remove(name)
+
+
+def _hostname():
+    h = _gethostname().split('.')[0]
+    if h:
+        return h
+    if 'fallback' not in _HOSTNAME:
+        from photon.util.system import get_hostname
+
+        _HOSTNAME['fallback'] = get_hostname()
+    return _HOSTNAME['fallback']
+
+
+def _timestamp():
+    from photon.util.system import get_timestamp
+
+    return get_timestamp()
+
+
+register_keyword('hostname', _hostname)
+register_keyword('timestamp', _timestamp, dynamic=True)
+
+
+def _loader_cache(loader, name):
+    cache = getattr(loader, name, None)
+    if cache is None:
+        cache = dict()
+        setattr(loader, name, cache)
+    return cache
 
 
 def yaml_str_join(l, n):
@@ -14,10 +103,15 @@ def yaml_str_join(l, n):
 
     The keywords are as following:
 
-    * `hostname`: Your hostname (from :func:`util.system.get_hostname`)
+    * `hostname`: Your hostname (from :py:func:`socket.gethostname`, \
+    falls back to :func:`util.system.get_hostname`)
 
     * `timestamp`: Current timestamp (from :func:`util.system.get_timestamp`)
 
+    * Anything added by :func:`register_keyword`
+
+    Each keyword is resolved only once per loaded YAML-file.
+
     :returns:
         A `non character` joined string |yaml_loader_returns|
 
@@ -27,15 +121,14 @@ def yaml_str_join(l, n):
     .. seealso:: |yaml_loader_seealso|
     '''
 
-    from photon.util.system import get_hostname, get_timestamp
-
+    cache = _loader_cache(l, '_photon_keywords')
     s = l.construct_sequence(n)
 
     for num, seq in enumerate(s):
-        if seq == 'hostname':
-            s[num] = '%s' % (get_hostname())
-        elif seq == 'timestamp':
-            s[num] = '%s' % (get_timestamp())
+        if isinstance(seq, str) and seq in KEYWORDS:
+            if seq not in cache:
+                cache[seq] = '%s' % (KEYWORDS[seq]())
+            s[num] = cache[seq]
     return ''.join([str(i) for i in s])
 
 
@@ -44,7 +137,7 @@ def yaml_loc_join(l, n):
     YAML loader to join paths
 
     The keywords come directly from :func:`util.locations.get_locations`.
-    See there!
+    See there! They are determined only once per loaded YAML-file.
 
     :returns:
         A `path seperator` (``/``) joined string |yaml_loader_returns|
@@ -52,17 +145,90 @@ def yaml_loc_join(l, n):
     .. seealso:: |yaml_loader_seealso|
     '''
 
-    from photon.util.locations import get_locations
+    locations = _loader_cache(l, '_photon_locations')
+    if not locations:
+        from photon.util.locations import get_locations
 
-    locations = get_locations()
+        locations.update(get_locations())
     s = l.construct_sequence(n)
 
     for num, seq in enumerate(s):
-        if seq in locations:
+        if isinstance(seq, str) and seq in locations:
             s[num] = '%s' % (locations[seq])
     return _path.join(*s)
 
 
+def yaml_include(l, n):
+    '''
+    YAML loader to include other YAML-files
+
+    The filename is located by :func:`util.locations.search_location`.
+    Pass a list to join it like :func:`yaml_loc_join` first
+    (e.g. ``!include [conf_dir, mesh.yaml]``).
+    The included file is read with the same loader,
+    so it may use ``!include`` (and the other loaders) itself.
+
+    Each file is parsed only once, no matter how often it is included
+    (by one or many YAML-files),
+    as long as it's fingerprint (see :func:`util.files.file_fingerprint`)
+    and the ones of files it includes stay the same.
+
+    :returns:
+        A copy of the content of the included file |yaml_loader_returns|
+
+    .. seealso:: |yaml_loader_seealso|
+    '''
+
+    from photon.util.files import file_fingerprint, read_yaml
+    from photon.util.locations import search_location
+
+    name = yaml_loc_join(l, n) if isinstance(
+        n, _SequenceNode
+    ) else l.construct_scalar(n)
+    filename = search_location(name)
+    if not filename:
+        raise _ConstructorError(
+            None, None, 'could not include %s' % (name), n.start_mark
+        )
+
+    stack = getattr(_INCLUDING, 'stack', None)
+    if stack is None:
+        stack = _INCLUDING.stack = list()
+    if filename in [f for f, _ in stack]:
+        raise _ConstructorError(
+            None, None, 'include loop at %s' % (filename), n.start_mark
+        )
+
+    key = (filename, type(l))
+    cached = _INCLUDES.get(key)
+    if not cached or any(
+        file_fingerprint(f) != fp for f, fp in cached[0].items()
+    ):
+        fingerprints = {filename: file_fingerprint(filename)}
+        stack.append((filename, fingerprints))
+        try:
+            content = read_yaml(filename, loader=type(l))
+        finally:
+            stack.pop()
+        cached = _INCLUDES[key] = (fingerprints, content)
+
+    for _, fingerprints in stack:
+        fingerprints.update(cached[0])
+    return _deepcopy(cached[1])
+
+
+def included_files():
+    '''
+    :returns:
+        A sorted list of the files included by :func:`yaml_include`
+        so far (and files included by them)
+    '''
+
+    return sorted(set(f for fingerprints, _ in list(
+        _INCLUDES.values()
+    ) for f in fingerprints))
+
+
 def dict_merge(o, v):
     '''
     Recursively climbs through dictionaries and merges them together.
@@ -90,6 +256,456 @@ def dict_merge(o, v):
     return res
 
 
+def dict_merge_shared(o, v, inplace=False):
+    '''
+    Merges dictionaries like :func:`dict_merge`, but without copying
+    everything: Only the dictionaries along the modified key paths are
+    copied, all other subtrees of `o` and `v` are shared with the result.
+
+    :param o:
+        The first dictionary
+    :param v:
+        The second dictionary
+    :param inplace:
+        Do not copy anything, modify `o` (and it's nested dictionaries
+        along the modified key paths) directly
+    :returns:
+        The merged dictionary (`o` itself if `inplace` is set)
+
+    .. note::
+        Changes to the result may show up in `o` or `v`
+        (and the other way round). Use it if both are not used anymore
+        or not changed afterwards (e.g. freshly loaded from a file)
+    '''
+
+    if not isinstance(v, dict):
+        return v
+    res = o if inplace else _copy(o)
+    for key, val in v.items():
+        if res.get(key) and isinstance(res[key], dict):
+            res[key] = dict_merge_shared(res[key], val, inplace=inplace)
+        else:
+            res[key] = val
+    return res
+
+
+def dict_stack(layers, base=None, provenance=None):
+    '''
+    Merges several dictionaries on top of each other in one pass.
+
+    Each layer is merged like :func:`dict_merge`, but (like
+    :func:`dict_merge_shared`) only the dictionaries along the modified
+    key paths are copied, and each of them only once for all layers.
+    The values taken from the layers are copied as well,
+    unless they are immutable (like strings or numbers).
+
+    :param layers:
+        A list of pairs of a name and a dictionary, the lowest one first
+    :param base:
+        The dictionary to start with (it is not modified)
+    :param provenance:
+        A provenance (see below) of `base` to continue.
+        It is updated in place
+    :returns:
+        The merged dictionary and the provenance:
+        A dictionary of each key path where a value was set,
+        and the name of the layer it was set by
+        (see :func:`dict_provenance`)
+
+    .. note::
+        Like with :func:`dict_merge_shared`, the result shares
+        untouched subtrees with `base` (but not with the layers)
+    '''
+
+    res = _copy(base) if base else dict()
+    owned = {id(res)}
+    if provenance is None:
+        provenance = dict()
+
+    def merge(target, v, prefix, name):
+        for key, val in v.items():
+            path = prefix + (key,)
+            cur = target.get(key)
+            if cur and isinstance(cur, dict) and isinstance(val, dict):
+                if id(cur) not in owned:
+                    cur = target[key] = _copy(cur)
+                    owned.add(id(cur))
+                merge(cur, val, path, name)
+            else:
+                target[key] = _deepcopy(val) if isinstance(
+                    val, (dict, list, set)
+                ) else val
+                provenance[path] = (next(_STACKED), name)
+
+    for name, layer in layers:
+        if layer and isinstance(layer, dict):
+            merge(res, layer, tuple(), name)
+    return res, provenance
+
+
+def dict_provenance(provenance, path):
+    '''
+    :param provenance:
+        A provenance returned by :func:`dict_stack`
+    :param path:
+        A key path (tuple of keys)
+    :returns:
+        The name of the layer which set the value at `path`
+        (or one of it's parents), or ``None`` if unknown
+    '''
+
+    res = None
+    for n in range(1, len(path) + 1):
+        entry = provenance.get(tuple(path[:n]))
+        if entry and (res is None or entry[0] > res[0]):
+            res = entry
+    return res[1] if res else None
+
+
+def dict_diff(o, v, prefix=tuple()):
+    '''
+    Recursively climbs through dictionaries and compares them.
+
+    :param o:
+        The first dictionary
+    :param v:
+        The second dictionary
+    :param prefix:
+        Put in front of each key path
+    :returns:
+        A sorted list of key paths (tuples of keys) which were added,
+        removed or changed from `o` to `v`.
+        Unchanged subtrees are left out, changed subtrees are
+        described down to their leaves
+    '''
+
+    res = list()
+    for key in set(o.keys()) | set(v.keys()):
+        path = prefix + (key,)
+        if key not in o or key not in v:
+            res.append(path)
+        elif isinstance(o[key], dict) and isinstance(v[key], dict):
+            res.extend(dict_diff(o[key], v[key], prefix=path))
+        elif o[key] != v[key]:
+            res.append(path)
+    return sorted(res, key=lambda p: [str(k) for k in p])
+
+
+def _is_mapping(value):
+    if isinstance(value, _MappingNode):
+        return value.tag == _MAP_TAG
+    return isinstance(value, dict)
+
+
+def _has_keys(value):
+    if isinstance(value, _MappingNode):
+        return bool(value.value)
+    return bool(value)
+
+
+def _fold(sources):
+    mappings, last = None, None
+    for loader, value in sources:
+        if loader and not _is_mapping(value):
+            loader, value = None, loader.construct_object(value, deep=True)
+        if _is_mapping(value):
+            if not mappings or not any(_has_keys(m) for _, m in mappings):
+                mappings = list()
+            mappings.append((loader, value))
+        else:
+            mappings, last = None, value
+
+    if mappings is not None:
+        return LazyDict(mappings)
+    return _deepcopy(last)
+
+
+class LazyDict(dict):
+    '''
+    A dictionary merged together from several layers
+    (the same way :func:`dict_merge` does it),
+    but each value is only constructed and merged on first access.
+
+    :param layers:
+        A list of pairs, either:
+
+        * A YAML loader and a mapping node composed by it. \
+        The values are constructed by the loader when needed
+
+        * ``None`` and a dictionary
+
+    Nested dictionaries become LazyDicts themselves.
+    Other nodes (e.g. ``!include``) are constructed before merging,
+    so they are merged like mappings if they turn out to be dictionaries.
+    Comparing, copying or dumping it resolves everything
+    (see :meth:`resolve`).
+    '''
+
+    def __init__(self, layers=None):
+        super().__init__()
+
+        self.__sources = dict()
+        for loader, mapping in layers or list():
+            self.merge(mapping, loader=loader)
+
+    def merge(self, mapping, loader=None):
+        '''
+        Merges another layer on top
+
+        :param mapping:
+            A mapping node (composed by `loader`),
+            a dictionary or another LazyDict
+        :param loader:
+            The YAML loader which composed `mapping`
+        '''
+
+        if isinstance(mapping, LazyDict):
+            pairs = [(key, mapping.sources(key)) for key in mapping]
+        elif loader:
+            loader.flatten_mapping(mapping)
+            pairs = [(
+                loader.construct_object(key, deep=True), [(loader, value)]
+            ) for key, value in mapping.value]
+        else:
+            pairs = [(key, [(None, value)]) for key, value in mapping.items()]
+
+        for key, sources in pairs:
+            if key in self:
+                sources = self.sources(key) + sources
+            self.__sources[key] = sources
+            dict.__setitem__(self, key, _PENDING)
+
+    def sources(self, key):
+        '''
+        :param key:
+            A key
+        :returns:
+            The layers of `key` not merged yet
+            (or it's value, if it was accessed before)
+        '''
+
+        value = dict.__getitem__(self, key)
+        if value is _PENDING:
+            return list(self.__sources[key])
+        return [(None, value)]
+
+    def resolve(self):
+        '''
+        :returns:
+            A plain dictionary with all values constructed
+        '''
+
+        return dict(
+            (key, val.resolve() if isinstance(val, LazyDict) else val)
+            for key, val in self.items()
+        )
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if value is _PENDING:
+            value = _fold(self.__sources.pop(key))
+            dict.__setitem__(self, key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        self.__sources.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.__sources.pop(key, None)
+        dict.__delitem__(self, key)
+
+    def __iter__(self):
+        return dict.__iter__(self)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyDict):
+            other = other.resolve()
+        return self.resolve() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.resolve())
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return _deepcopy(self.resolve(), memo)
+
+    def copy(self):
+        return dict(self.items())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        key = next(reversed(self.keys()))
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+class KeyIndex(object):
+    '''
+    A flattened index of all key paths within nested dictionaries.
+    It is built once, all lookups are done without walking the structure.
+
+    :param structure:
+        The nested dictionaries (or other mappings) to index
+    :param sep:
+        Separator of dotted paths (see :meth:`get`)
+
+    Paths are tuples of keys (the empty tuple is `structure` itself).
+    '''
+
+    def __init__(self, structure, sep='.'):
+        super().__init__()
+
+        self.__sep = sep
+        self.__values = dict()
+        self.__dotted = dict()
+        self.__children = dict()
+        self.__reverse = dict()
+
+        stack = [(tuple(), structure)]
+        while stack:
+            path, value = stack.pop()
+            self.__values[path] = value
+            self.__dotted.setdefault(self.dotted(path), path)
+            if isinstance(value, _Mapping):
+                self.__children[path] = [path + (k,) for k in value.keys()]
+                stack.extend(
+                    (child, value[child[-1]])
+                    for child in reversed(self.__children[path])
+                )
+            else:
+                rkey = self.__rkey(value)
+                if rkey is not None:
+                    self.__reverse.setdefault(rkey, list()).append(path)
+
+    def dotted(self, path):
+        '''
+        :param path:
+            A key path
+        :returns:
+            The key path as dotted string
+        '''
+
+        return self.__sep.join(str(k) for k in path)
+
+    def path(self, path):
+        '''
+        :param path:
+            A key path, a list of keys or a dotted string
+            (like ``'a.b.c'``)
+        :returns:
+            The key path as tuple (or ``None`` if it is not indexed).
+            Strings are looked up as single key first
+        '''
+
+        if isinstance(path, str):
+            if (path,) in self.__values:
+                return (path,)
+            return self.__dotted.get(path)
+        path = tuple(path)
+        if path in self.__values:
+            return path
+
+    def get(self, path, default=None):
+        '''
+        :param path:
+            A key path, list of keys or a dotted string (see :meth:`path`)
+        :param default:
+            Returned if `path` is not indexed
+        :returns:
+            The value at `path`
+        '''
+
+        path = self.path(path)
+        return default if path is None else self.__values[path]
+
+    def paths(self, prefix=tuple(), leaves=True):
+        '''
+        :param prefix:
+            Only paths below this one (see :meth:`path`)
+        :param leaves:
+            Only paths which lead to something else than a dictionary
+        :returns:
+            A list of all key paths below `prefix`, in order
+        '''
+
+        prefix = self.path(prefix)
+        if prefix is None:
+            return list()
+        res, stack = list(), [prefix]
+        while stack:
+            path = stack.pop()
+            children = self.__children.get(path)
+            if path != prefix and not (leaves and children is not None):
+                res.append(path)
+            if children:
+                stack.extend(reversed(children))
+        return res
+
+    def find(self, value):
+        '''
+        :param value:
+            A value to look for
+        :returns:
+            A list of all key paths leading to `value`.
+            Dictionaries (and lists containing them) are not indexed,
+            so they are never found
+        '''
+
+        return list(self.__reverse.get(self.__rkey(value), list()))
+
+    def __contains__(self, path):
+        return self.path(path) is not None
+
+    def __getitem__(self, path):
+        p = self.path(path)
+        if p is None:
+            raise KeyError(path)
+        return self.__values[p]
+
+    def __len__(self):
+        return len(self.__values)
+
+    def __rkey(self, value):
+        if isinstance(value, list):
+            value = tuple(self.__rkey(v) for v in value)
+            if None in value:
+                return
+        try:
+            hash(value)
+        except TypeError:
+            return
+        return type(value).__name__, value
+
+
 def to_list(i, use_keys=False):
     '''
     Converts items to a list.
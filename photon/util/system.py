@@ -10,6 +10,7 @@ from subprocess import PIPE as _PIPE
 from subprocess import Popen as _Popen
 from subprocess import TimeoutExpired as _TimeoutExpired
 from sys import exit as _exit
+from time import monotonic as _monotonic
 
 
 def shell_notify(msg, state=False, more=None, exitcode=None, verbose=True):
@@ -121,6 +122,8 @@ def shell_run(cmd,
 
         * 'out': The most urgent message as joined string. \
         ('exception' > 'stderr' > 'stdout')
+
+        * 'duration': How long `cmd` took, in seconds
     '''
 
     res = dict(command=cmd)
@@ -133,6 +136,7 @@ def shell_run(cmd,
     if isinstance(cmd, str):
         cmd = _split(cmd)
 
+    started = _monotonic()
     try:
         p = _Popen(
             cmd, stdin=_PIPE, stdout=_PIPE, stderr=_PIPE,
@@ -164,7 +168,8 @@ def shell_run(cmd,
         out=(
             res.get('exception') or
             '\n'.join(res.get('stderr') or res.get('stdout', ''))
-        )
+        ),
+        duration=_monotonic() - started
     )
 
     if res.get('returncode', -1) != 0:
@@ -203,6 +208,25 @@ def get_timestamp(time=True, precice=False):
     return _datetime.now().strftime(f)
 
 
+def parse_timestamp(stamp):
+    '''
+    Converts timestamps back
+
+    :param stamp:
+        A timestamp string as returned by :func:`get_timestamp`
+        (with or without `time` and `precice`)
+    :returns:
+        The seconds since the epoch as float,
+        or ``None`` if `stamp` could not be parsed
+    '''
+
+    for f in ['%Y.%m.%d-%H.%M.%S-%f', '%Y.%m.%d-%H.%M.%S', '%Y.%m.%d']:
+        try:
+            return _datetime.strptime(stamp, f).timestamp()
+        except (TypeError, ValueError):
+            continue
+
+
 def get_hostname():
     '''
     Determines the current hostname by probing  ``uname -n``.
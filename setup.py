@@ -28,7 +28,11 @@ setup(
     include_package_data=True,
     zip_safe=False,
     platforms='posix',
-    scripts=['photon-settings-tool.py', 'photon-dangerous-selfupgrade.py'],
+    scripts=[
+        'photon-settings-tool.py',
+        'photon-meta.py',
+        'photon-dangerous-selfupgrade.py'
+    ],
     provides=[pkg_name()],
     install_requires=['PyYAML'],
     classifiers=[